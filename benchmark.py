@@ -0,0 +1,780 @@
+"""Offline benchmark for the bot's hot paths.
+
+Drives the real handlers from main.py through a stub Telegram client with
+configurable RPC latency and FloodWait injection, against an in-memory Mongo
+(mongomock) or a local MongoDB. Needs the packages in requirements.txt plus
+mongomock for the default in-memory database.
+
+    python benchmark.py                                  # all scenarios, JSON on stdout
+    python benchmark.py --scenario forwards --rpc-latency 0.05 --flood-rate 0.01
+    python benchmark.py --scenario albums --albums 500 --flood-rate 0.05
+    python benchmark.py --output new.json --compare old.json
+    python benchmark.py --scenario broadcast --broadcast-users 100000 --mongo-uri mongodb://localhost:27017
+    python benchmark.py --scenario sharding --mongo-uri mongodb://localhost:27017   # one process per worker
+
+Runs are seeded, so results from two commits are comparable. --mongo-uri
+wipes the database it is pointed at; never use it against production.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+import types
+
+from pyrogram import raw
+from pyrogram.enums import ChatMemberStatus, ChatType
+from pyrogram.errors import FloodWait
+from pyrogram.session import Session
+
+from metrics import MONGO_LATENCY, RAISE_FLOOD_WAIT, InstrumentedClient, flood_sleep_threshold
+import sharding
+
+# Placeholders so main.py can be imported without real credentials.
+BENCH_ENV = {
+    'API_ID': '1',
+    'API_HASH': 'benchmark',
+    'BOT_TOKEN': '1:benchmark',
+    'ADMIN_ID': '1000',
+    'LOG_CHANNEL_ID': '-1000',
+    'ADMIN_USERNAME': 'benchmark_admin',
+}
+# RPC methods that can fail with an injected FloodWait.
+FLOOD_METHODS = {'get_messages', 'send_message', 'send_multi_media', 'delete_messages'}
+
+
+# --- Stub Telegram Client ---
+class StubClient:
+    """Stands in for the Pyrogram client: every RPC sleeps for `latency` seconds and is counted.
+
+    Calls to FLOOD_METHODS fail with FloodWait(`flood_seconds`) with probability
+    `flood_rate`. As in Session.invoke, waits up to the sleep threshold are slept
+    through and the call is sent again; longer ones are raised. The threshold is
+    chosen like InstrumentedClient does: the context's, else the one the method
+    passes in Pyrogram, else `sleep_threshold`.
+    Helpers that make several RPCs in Pyrogram (copy_message, copy_media_group)
+    count each of them.
+    """
+
+    def __init__(self, latency: float, flood_rate: float, flood_seconds: int, seed: int, sleep_threshold: int):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.sleep_threshold = sleep_threshold
+        self.random = random.Random(seed)
+        self.calls = collections.Counter()
+        self.flood_waits = 0
+        self.flood_waits_slept = 0
+        # (chat_id, message_id) -> time the original message was deleted
+        self.deleted = {}
+        # chat_id -> time of the first successful copy into that chat
+        self.delivered = {}
+        self.me = types.SimpleNamespace(id=1, username='benchmark_bot')
+        self.next_message_id = 1
+
+    async def rpc(self, method: str, sleep_threshold: int = None):
+        threshold = flood_sleep_threshold.get()
+        if threshold is None:
+            threshold = self.sleep_threshold if sleep_threshold is None else sleep_threshold
+        while True:
+            self.calls[method] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if method not in FLOOD_METHODS or self.random.random() >= self.flood_rate:
+                return
+            if self.flood_seconds > threshold >= 0:
+                self.flood_waits += 1
+                raise FloodWait(value=self.flood_seconds)
+            self.flood_waits_slept += 1
+            await asyncio.sleep(self.flood_seconds)
+
+    async def get_chat_member(self, chat_id, user_id):
+        await self.rpc('get_chat_member')
+        return types.SimpleNamespace(
+            status=ChatMemberStatus.ADMINISTRATOR,
+            privileges=types.SimpleNamespace(can_delete_messages=True),
+        )
+
+    async def get_chat(self, chat_id):
+        await self.rpc('get_chat')
+        return types.SimpleNamespace(id=chat_id, title=f"Channel {chat_id}", username=None, type=ChatType.CHANNEL)
+
+    async def get_messages(self, chat_id, message_ids):
+        await self.rpc('get_messages', sleep_threshold=-1)
+        return StubMessage(self, chat_id, message_ids, empty=False)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self.rpc('send_message')
+        return self.stub_message(chat_id)
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        source = await self.get_messages(from_chat_id, message_id)
+        return await source.copy(chat_id)
+
+    async def copy_media_group(self, chat_id, from_chat_id, message_id, **kwargs):
+        # get_media_group fetches the album with a single get_messages call.
+        await self.rpc('get_messages', sleep_threshold=-1)
+        await self.rpc('send_multi_media', sleep_threshold=60)
+        return [self.stub_message(chat_id)]
+
+    async def delete_messages(self, chat_id, message_ids):
+        await self.rpc('delete_messages')
+        ids = message_ids if isinstance(message_ids, list) else [message_ids]
+        now = time.perf_counter()
+        for message_id in ids:
+            self.deleted[(chat_id, message_id)] = now
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        await self.rpc('edit_message_text')
+
+    def stub_message(self, chat_id: int, **fields):
+        self.next_message_id += 1
+        return StubMessage(self, chat_id, self.next_message_id, **fields)
+
+
+class StubMessage:
+    """The parts of pyrogram.types.Message the handlers use; bound methods go through the client."""
+
+    def __init__(self, client: StubClient, chat_id: int, message_id: int, user_id: int = None, text: str = '', **fields):
+        self.client = client
+        self.chat = types.SimpleNamespace(id=chat_id, title=f"Chat {chat_id}", username=None)
+        self.id = message_id
+        self.from_user = types.SimpleNamespace(id=user_id, username=f"user{user_id}", first_name=f"User {user_id}")
+        self.text = text
+        self.command = text.lstrip('/').split() if text.startswith('/') else None
+        self.forward_from_chat = None
+        self.forward_from = None
+        self.media_group_id = None
+        self.reply_to_message = None
+        self.__dict__.update(fields)
+
+    async def reply_text(self, text, **kwargs):
+        return await self.client.send_message(self.chat.id, text)
+
+    async def copy(self, chat_id, **kwargs):
+        # Message.copy resends the content it already has, without fetching the message.
+        copied = await self.client.send_message(chat_id, self.text)
+        self.client.delivered.setdefault(chat_id, time.perf_counter())
+        return copied
+
+    async def delete(self):
+        await self.client.delete_messages(self.chat.id, [self.id])
+
+
+# --- Measurement ---
+def percentile(values: list, fraction: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def mongo_usage():
+    """Reads per-operation Mongo call counts and total seconds from the MONGO_LATENCY histogram."""
+    counts = collections.Counter()
+    seconds = collections.Counter()
+    for metric in MONGO_LATENCY.collect():
+        for sample in metric.samples:
+            operation = f"{sample.labels['collection']}.{sample.labels['operation']}"
+            if sample.name.endswith('_count'):
+                counts[operation] += int(sample.value)
+            elif sample.name.endswith('_sum'):
+                seconds[operation] += sample.value
+    return counts, seconds
+
+
+def reset_state():
+    """Empties the database and the in-memory caches so every scenario starts cold."""
+    main.db.client.drop_database(main.db.db.name)
+    for cache in (main.premium_cache, main.bot_permissions, main.membership_cache, main.handled_messages):
+        cache.clear()
+    main.channel_registry.channel_ids.clear()
+
+
+async def run_concurrently(jobs: list, concurrency: int):
+    """Awaits every job with at most `concurrency` in flight.
+
+    Returns the latencies and the number of jobs that raised, e.g. an injected
+    FloodWait escaping a handler as it would in production.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = collections.Counter()
+
+    async def timed(job):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await job()
+            except Exception as e:
+                errors[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(timed(job) for job in jobs))
+    return latencies, {'handler_errors': dict(errors)}
+
+
+# --- Scenarios ---
+# Each scenario has an untimed setup and a timed run returning (operations, latencies, extra results).
+async def scenario_start(client: StubClient, args):
+    """/start from many distinct users: membership check plus user upsert."""
+    jobs = [
+        lambda user_id=user_id: main.start_command(client, StubMessage(client, user_id, 1, user_id, '/start'))
+        for user_id in range(1, args.users + 1)
+    ]
+    return (args.users, *await run_concurrently(jobs, args.concurrency))
+
+
+async def scenario_addchannel(client: StubClient, args):
+    """Every user adds two free channels."""
+    jobs = []
+    for user_id in range(1, args.users + 1):
+        for n in range(2):
+            channel_id = -(10 ** 12) - user_id * 2 - n
+            message = StubMessage(client, user_id, 1, user_id, f"/addchannel {channel_id}")
+            jobs.append(lambda message=message: main.addchannel_command(client, message))
+    return (len(jobs), *await run_concurrently(jobs, args.concurrency))
+
+
+def forward_channel_ids(args) -> list:
+    return [-(10 ** 12) - n for n in range(args.channels)]
+
+
+async def setup_forwards(args):
+    for channel_id in forward_channel_ids(args):
+        main.channel_registry.add(channel_id)
+
+
+async def scenario_forwards(client: StubClient, args):
+    """Bursts of forwarded posts spread over many channels, some of them redelivered."""
+    rng = random.Random(args.seed)
+    channel_ids = forward_channel_ids(args)
+    next_id = collections.Counter()
+    sent_at = {}
+    duplicates = 0
+    dedup_before = dict(main.handled_messages.stats)
+    scheduler_before = main.scheduler.snapshot()
+    while len(sent_at) < args.forwards:
+        channel_id = rng.choice(channel_ids)
+        for _ in range(min(rng.randint(1, args.burst), args.forwards - len(sent_at))):
+            next_id[channel_id] += 1
+            message = StubMessage(client, channel_id, next_id[channel_id], forward_from_chat=True)
+            sent_at[(channel_id, message.id)] = time.perf_counter()
+            await main.handle_forwarded_messages(client, message)
+            if rng.random() < args.duplicate_rate:
+                duplicates += 1
+                await main.handle_forwarded_messages(client, message)
+        # Let the workers run between bursts, as they would between incoming updates.
+        await asyncio.sleep(0)
+    while main.scheduler.channels:
+        await asyncio.sleep(0.01)
+    latencies = [client.deleted[key] - sent for key, sent in sent_at.items() if key in client.deleted]
+    dedup = {key: value - dedup_before[key] for key, value in main.handled_messages.stats.items()}
+    snapshot = main.scheduler.snapshot()
+    return len(sent_at), latencies, {
+        'reposted': len(latencies),
+        'duplicates_sent': duplicates,
+        'duplicates_skipped': dedup['memory_hits'] + dedup['mongo_hits'],
+        'dropped': snapshot['dropped'] - scheduler_before['dropped'],
+        'retries': snapshot['retries'] - scheduler_before['retries'],
+    }
+
+
+async def scenario_albums(client: StubClient, args):
+    """Forwarded albums of 2-10 items; latency is from an album's first item until all originals are deleted."""
+    rng = random.Random(args.seed)
+    channel_ids = forward_channel_ids(args)
+    main.album_buffer.window = args.album_window
+    next_id = collections.Counter()
+    albums = {}
+    scheduler_before = main.scheduler.snapshot()
+    for group in range(1, args.albums + 1):
+        channel_id = rng.choice(channel_ids)
+        keys = []
+        for _ in range(rng.randint(2, 10)):
+            next_id[channel_id] += 1
+            message = StubMessage(client, channel_id, next_id[channel_id], forward_from_chat=True, media_group_id=str(group))
+            keys.append((channel_id, message.id))
+            await main.handle_forwarded_messages(client, message)
+        albums[group] = (time.perf_counter(), keys)
+        await asyncio.sleep(0)
+    while main.album_buffer.albums or main.scheduler.channels:
+        await asyncio.sleep(0.01)
+    latencies = [
+        max(client.deleted[key] for key in keys) - started
+        for started, keys in albums.values() if all(key in client.deleted for key in keys)
+    ]
+    snapshot = main.scheduler.snapshot()
+    return len(albums), latencies, {
+        'album_items': sum(len(keys) for _, keys in albums.values()),
+        'reposted': len(latencies),
+        'dropped': snapshot['dropped'] - scheduler_before['dropped'],
+        'retries': snapshot['retries'] - scheduler_before['retries'],
+    }
+
+
+async def setup_broadcast(args):
+    for start in range(0, args.broadcast_users, 10000):
+        end = min(start + 10000, args.broadcast_users)
+        await main.db.users.collection.insert_many([{'user_id': user_id} for user_id in range(start + 1, end + 1)])
+
+
+async def scenario_broadcast(client: StubClient, args):
+    """/broadcast to a large user base; latency is the time until each user received the post."""
+    admin = main.ADMIN_ID
+    source = StubMessage(client, admin, 1, admin, 'Announcement')
+    command = StubMessage(client, admin, 2, admin, '/broadcast', reply_to_message=source)
+    started = time.perf_counter()
+    await main.broadcast_command(client, command)
+    while main.broadcasts.active:
+        await asyncio.sleep(0.05)
+    latencies = [delivered - started for chat_id, delivered in client.delivered.items() if chat_id != admin]
+    job = (await main.db.broadcast_jobs.recent(1))[0]
+    return args.broadcast_users, latencies, {'status': job['status'], 'counts': job['counts']}
+
+
+class FloodingSession(Session):
+    """Session whose `send` fails with FloodWait a set number of times.
+
+    Lets the real Client.invoke and Session.invoke, where Pyrogram decides
+    whether to sleep through a FloodWait, run without a connection.
+    """
+
+    def __init__(self, client, floods: int, flood_seconds: int):
+        # Session.__init__ prepares a connection; only what invoke uses is set up here.
+        self.client = client
+        self.is_started = asyncio.Event()
+        self.is_started.set()
+        self.floods = floods
+        self.flood_seconds = flood_seconds
+        self.sent = 0
+
+    async def send(self, data, wait_response: bool = True, timeout: float = Session.WAIT_TIMEOUT):
+        self.sent += 1
+        if self.floods:
+            self.floods -= 1
+            raise FloodWait(value=self.flood_seconds)
+        return raw.types.messages.AffectedMessages(pts=1, pts_count=1)
+
+
+async def scenario_flood_path(client: StubClient, args):
+    """Checks where FloodWait is slept through, going through Pyrogram's own invoke path.
+
+    Uses an InstrumentedClient configured like the bot's. In an unmarked
+    context (handlers, Pyrogram's fetches while parsing updates, start-up)
+    short waits must be slept through, including for get_messages' "always
+    sleep". Where the context asks for FloodWait to be raised, as in
+    broadcasts, it must be raised at once even for methods that ask Pyrogram
+    to sleep (copy_media_group passes 60s, get_messages "always"). A
+    scheduled job must be parked and retried. Raises AssertionError if any of
+    this does not hold.
+    """
+    telegram = InstrumentedClient(
+        'benchmark_flood_check', api_id=1, api_hash='benchmark', in_memory=True, sleep_threshold=main.app.sleep_threshold
+    )
+    await telegram.storage.open()
+    telegram.is_connected = True
+    query = raw.functions.messages.DeleteMessages(id=[1], revoke=True)
+    latencies = []
+
+    async def invoke_with_one_flood(**kwargs) -> bool:
+        """Returns True if the call succeeded after sleeping, False if FloodWait was raised."""
+        telegram.session = FloodingSession(telegram, 1, args.flood_seconds)
+        started = time.perf_counter()
+        try:
+            await telegram.invoke(query, **kwargs)
+            return True
+        except FloodWait:
+            return False
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    for requested in (None, -1):
+        assert await invoke_with_one_flood(sleep_threshold=requested), \
+            f"A short FloodWait was raised in an unmarked context (method sleep_threshold={requested})"
+
+    async def raising_context(requested) -> bool:
+        flood_sleep_threshold.set(RAISE_FLOOD_WAIT)
+        return await invoke_with_one_flood(sleep_threshold=requested)
+
+    for requested in (None, 60, -1):
+        # A task gets a copy of the context, so the setting does not leak into this one.
+        assert not await asyncio.create_task(raising_context(requested)), \
+            f"FloodWait was slept through where it must be raised (method sleep_threshold={requested})"
+
+    # The first attempt raises FloodWait; the scheduler must park the channel and retry.
+    telegram.session = FloodingSession(telegram, 1, args.flood_seconds)
+    done = asyncio.Event()
+
+    async def job():
+        await telegram.invoke(query)
+        done.set()
+
+    scheduler_before = main.scheduler.snapshot()
+    started = time.perf_counter()
+    main.scheduler.submit(-1, job)
+    await asyncio.wait_for(done.wait(), args.flood_seconds + 10)
+    latencies.append(time.perf_counter() - started)
+    parked = main.scheduler.snapshot()['flood_waits'] - scheduler_before['flood_waits']
+    assert parked == 1 and telegram.session.sent == 2, "The scheduler did not park and retry the flooded job"
+    await telegram.storage.close()
+    return len(latencies), latencies, {'checks_passed': len(latencies), 'scheduler_parks': parked}
+
+
+async def shard_worker(db, shard_id: int, shards: int, report):
+    """One shard worker without a Telegram client: a ShardCoordinator and a CacheSync.
+
+    Reports slot changes and applied cache events through `report`, and
+    publishes one probe event once it has started. Runs until cancelled, then
+    stops the way run_bot does.
+    """
+    coordinator = sharding.ShardCoordinator(db.leases, shards, shard_id)
+    cache_sync = sharding.CacheSync(db.cache_events, coordinator)
+
+    async def acquired(slot):
+        report({'event': 'acquired', 'worker': shard_id, 'slot': slot})
+
+    async def released(slot):
+        report({'event': 'released', 'worker': shard_id, 'slot': slot})
+
+    async def probe_applied(key):
+        report({'event': 'applied', 'worker': shard_id, 'key': key})
+
+    coordinator.on_acquire.append(acquired)
+    coordinator.on_release.append(released)
+    cache_sync.on('probe', probe_applied)
+    report({'event': 'started', 'worker': shard_id})
+    await coordinator.start()
+    sync_task = asyncio.create_task(cache_sync.run())
+    key = f"{shard_id}:{time.time()}"
+    await cache_sync.publish('probe', key)
+    report({'event': 'published', 'worker': shard_id, 'key': key})
+    try:
+        await asyncio.Event().wait()
+    finally:
+        sync_task.cancel()
+        await coordinator.stop()
+        report({'event': 'stopped', 'worker': shard_id})
+
+
+async def run_shard_worker_process(args):
+    """Entry point of a worker process started by the sharding scenario; reports as JSON lines."""
+    from database import Database
+
+    def report(event):
+        print(json.dumps({**event, 'at': time.time()}), flush=True)
+
+    task = asyncio.create_task(shard_worker(Database(args.mongo_uri), args.shard_worker, args.shards, report))
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+class ShardWorkers:
+    """Starts and stops shard workers for the sharding scenario and collects their reports.
+
+    Against a MongoDB server every worker is a separate process. mongomock
+    cannot be shared between processes, so there the workers run as tasks in
+    this process on the shared in-memory database.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.in_process = args.mongo_uri.startswith('mongomock://')
+        self.events = []
+        self.running = {}
+
+    def report(self, event: dict):
+        self.events.append({**event, 'at': time.time()})
+
+    async def start(self, shard_id: int):
+        if self.in_process:
+            self.running[shard_id] = asyncio.create_task(shard_worker(main.db, shard_id, self.args.shards, self.report))
+            return
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), '--shard-worker', str(shard_id),
+            '--shards', str(self.args.shards), '--mongo-uri', self.args.mongo_uri,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        self.running[shard_id] = (process, asyncio.create_task(self.read(process)))
+
+    async def read(self, process):
+        async for line in process.stdout:
+            try:
+                self.events.append(json.loads(line))
+            except ValueError:
+                pass
+
+    async def stop(self, shard_id: int):
+        worker = self.running.pop(shard_id)
+        if self.in_process:
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+            return
+        process, reader = worker
+        process.terminate()
+        await process.wait()
+        await reader
+
+    async def wait_for(self, description: str, predicate, timeout: float):
+        deadline = time.monotonic() + timeout
+        while not any(predicate(event) for event in self.events):
+            assert time.monotonic() < deadline, f"Timed out waiting for {description}"
+            await asyncio.sleep(0.05)
+        return next(event for event in self.events if predicate(event))
+
+
+def slot_overlaps(events: list) -> int:
+    """Counts acquisitions of a slot that another worker still held at the time."""
+    owners = collections.defaultdict(set)
+    overlaps = 0
+    for event in sorted(events, key=lambda event: event['at']):
+        if event['event'] == 'acquired':
+            overlaps += bool(owners[event['slot']] - {event['worker']})
+            owners[event['slot']].add(event['worker'])
+        elif event['event'] == 'released':
+            owners[event['slot']].discard(event['worker'])
+    return overlaps
+
+
+async def scenario_sharding(client: StubClient, args):
+    """Runs --shards workers, stops one and restarts it; latency is how long cache events take to spread.
+
+    Checks that every slot is owned by exactly one worker, that a stopped
+    worker's slot is taken over and handed back when it returns, and that
+    every running worker applies the cache events of the others. Uses the
+    SHARD_* and CACHE_SYNC_* settings from the environment. Raises
+    AssertionError if any of this does not hold.
+    """
+    workers = ShardWorkers(args)
+    timeout = sharding.SHARD_LEASE_TTL + 2 * sharding.SHARD_RENEW_INTERVAL
+    try:
+        for shard_id in range(args.shards):
+            await workers.start(shard_id)
+        for slot in range(args.shards):
+            await workers.wait_for(
+                f"slot {slot}", lambda e, slot=slot: e['event'] == 'acquired' and e['slot'] == slot, timeout
+            )
+        await asyncio.sleep(2 * sharding.CACHE_SYNC_INTERVAL)
+
+        # Worker 1 shuts down; one of the others must take slot 1 over.
+        stopped_at = time.time()
+        await workers.stop(1)
+        taken = await workers.wait_for(
+            "slot 1 to be taken over",
+            lambda e: e['event'] == 'acquired' and e['slot'] == 1 and e['worker'] != 1 and e['at'] >= stopped_at,
+            timeout,
+        )
+        released = max(e['at'] for e in workers.events if e['event'] == 'released' and e['worker'] == 1)
+        takeover_gap = taken['at'] - released
+
+        # Worker 1 comes back with the same identity and gets its slot back.
+        restarted_at = time.time()
+        await workers.start(1)
+        returned = await workers.wait_for(
+            "slot 1 to be handed back",
+            lambda e: e['event'] == 'acquired' and e['slot'] == 1 and e['worker'] == 1 and e['at'] >= restarted_at,
+            timeout,
+        )
+        handed_over = max(
+            e['at'] for e in workers.events
+            if e['event'] == 'released' and e['slot'] == 1 and e['worker'] == taken['worker']
+        )
+        handback_gap = returned['at'] - handed_over
+        await asyncio.sleep(2 * sharding.CACHE_SYNC_INTERVAL)
+    finally:
+        for shard_id in list(workers.running):
+            await workers.stop(shard_id)
+
+    events = workers.events
+    latencies = []
+    missed = 0
+    for published in [e for e in events if e['event'] == 'published']:
+        # Workers that were running when the probe was published, other than its publisher.
+        running = set()
+        for e in sorted(events, key=lambda e: e['at']):
+            if e['at'] > published['at']:
+                break
+            if e['event'] == 'started':
+                running.add(e['worker'])
+            elif e['event'] == 'stopped':
+                running.discard(e['worker'])
+        running.discard(published['worker'])
+        applied = {}
+        for e in events:
+            # A restarted worker applies recent events again; only the first time counts.
+            if e['event'] == 'applied' and e['key'] == published['key']:
+                applied.setdefault(e['worker'], e['at'])
+        missed += len(running - set(applied))
+        latencies += [applied[worker] - published['at'] for worker in running & set(applied)]
+    overlaps = slot_overlaps(events)
+    assert overlaps == 0, f"{overlaps} slot(s) were held by two workers at once"
+    assert missed == 0, f"{missed} cache event(s) were not applied by a running worker"
+    return len(latencies), latencies, {
+        'mode': 'in-process' if workers.in_process else 'processes',
+        'workers': args.shards,
+        'takeover_gap_ms': round(takeover_gap * 1000, 3),
+        'handback_gap_ms': round(handback_gap * 1000, 3),
+    }
+
+
+# name -> (setup, scenario)
+SCENARIOS = {
+    'start': (None, scenario_start),
+    'addchannel': (None, scenario_addchannel),
+    'forwards': (setup_forwards, scenario_forwards),
+    'albums': (setup_forwards, scenario_albums),
+    'broadcast': (setup_broadcast, scenario_broadcast),
+    'flood_path': (None, scenario_flood_path),
+    'sharding': (None, scenario_sharding),
+}
+
+
+async def run_scenario(name: str, args) -> dict:
+    setup, scenario = SCENARIOS[name]
+    reset_state()
+    if setup:
+        await setup(args)
+    # Built after seeding: mongomock checks unique indexes with a full scan per insert.
+    await main.db.ensure_indexes()
+    client = StubClient(args.rpc_latency, args.flood_rate, args.flood_seconds, args.seed, main.app.sleep_threshold)
+    calls_before, seconds_before = mongo_usage()
+    started = time.perf_counter()
+    operations, latencies, extra = await scenario(client, args)
+    elapsed = time.perf_counter() - started
+    calls_after, seconds_after = mongo_usage()
+    mongo_calls = calls_after - calls_before
+    mongo_seconds = seconds_after - seconds_before
+    return {
+        'operations': operations,
+        'seconds': round(elapsed, 4),
+        'throughput': round(operations / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        'max_ms': round(max(latencies) * 1000, 3) if latencies else None,
+        'rpc_calls': sum(client.calls.values()),
+        'rpc_calls_by_method': dict(sorted(client.calls.items())),
+        'flood_waits': client.flood_waits,
+        'flood_waits_slept': client.flood_waits_slept,
+        'db_calls': sum(mongo_calls.values()),
+        'db_calls_by_operation': dict(sorted(mongo_calls.items())),
+        'db_seconds': round(sum(mongo_seconds.values()), 4),
+        'db_seconds_by_operation': {key: round(value, 4) for key, value in sorted(mongo_seconds.items())},
+        **extra,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report: dict, baseline: dict):
+    """Prints the change in throughput, p99 and call counts against an earlier report to stderr."""
+    print(f"Compared with {baseline.get('commit')}:", file=sys.stderr)
+    settings = baseline.get('settings', {})
+    changed = sorted(key for key, value in report['settings'].items() if key != 'scenario' and settings.get(key) != value)
+    if changed:
+        print(f"  Warning: settings differ ({', '.join(changed)}); results are not directly comparable.", file=sys.stderr)
+    for name, result in report['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        changes = []
+        for key in ('throughput', 'p99_ms', 'rpc_calls', 'db_calls'):
+            if before.get(key) and result.get(key) is not None:
+                changes.append(f"{key} {before[key]} -> {result[key]} ({(result[key] / before[key] - 1):+.1%})")
+        print(f"  {name}: " + ', '.join(changes), file=sys.stderr)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the bot's handlers.")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help="Run only these scenarios (repeatable).")
+    parser.add_argument('--mongo-uri', default='mongomock://localhost', help="Database to use; it is wiped before each scenario.")
+    parser.add_argument('--rpc-latency', type=float, default=0.0, help="Seconds every stub RPC takes.")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="Probability that a fetch, send or delete RPC raises FloodWait.")
+    parser.add_argument('--flood-seconds', type=int, default=1, help="FloodWait duration for injected errors.")
+    parser.add_argument('--users', type=int, default=1000, help="Users for the start and addchannel scenarios.")
+    parser.add_argument('--concurrency', type=int, default=100, help="Commands in flight at once.")
+    parser.add_argument('--channels', type=int, default=1000, help="Channels in the forwards scenario.")
+    parser.add_argument('--forwards', type=int, default=10000, help="Forwarded posts in the forwards scenario.")
+    parser.add_argument('--burst', type=int, default=20, help="Largest burst of posts to one channel.")
+    parser.add_argument('--albums', type=int, default=500, help="Forwarded albums in the albums scenario.")
+    parser.add_argument(
+        '--album-window', type=float, default=0.05,
+        help="ALBUM_COLLECT_WINDOW for the albums scenario; the production default (1.5s) only adds idle time."
+    )
+    parser.add_argument('--duplicate-rate', type=float, default=0.01, help="Share of posts delivered twice.")
+    parser.add_argument(
+        '--broadcast-users', type=int, default=20000,
+        help="Recipients in the broadcast scenario. mongomock scans the whole collection for every batch, "
+             "so use --mongo-uri with a local MongoDB for 100k+."
+    )
+    parser.add_argument(
+        '--broadcast-rate', type=float, default=1e9,
+        help="BROADCAST_RATE for the run; the production default (25/s) would make large broadcasts take hours."
+    )
+    parser.add_argument('--shards', type=int, default=3, help="Workers in the sharding scenario.")
+    parser.add_argument('--shard-worker', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="Also write the JSON report to this file.")
+    parser.add_argument('--compare', help="Earlier JSON report to compare against.")
+    return parser.parse_args()
+
+
+async def run(args) -> dict:
+    main.scheduler.start()
+    scenarios = {}
+    for name in args.scenario or list(SCENARIOS):
+        print(f"Running scenario {name}...", file=sys.stderr)
+        scenarios[name] = await run_scenario(name, args)
+    return {
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'scenarios': scenarios,
+    }
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # Every worker derives its own ID from its shard; a fixed one would make them all the same worker.
+    os.environ.pop('SHARD_WORKER_ID', None)
+    if args.shard_worker is not None:
+        logging.basicConfig(level=logging.ERROR)
+        asyncio.run(run_shard_worker_process(args))
+        sys.exit(0)
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+    os.environ['MONGO_URI'] = args.mongo_uri
+    os.environ['BROADCAST_RATE'] = str(args.broadcast_rate)
+    # Keeps the default in-memory dedup window so runs do not depend on the caller's environment.
+    os.environ.pop('DEDUP_PERSIST_WINDOW', None)
+
+    import main
+    # Per-message info logs would dominate the measurements.
+    for name in ('main', 'scheduler', 'broadcast', 'sharding'):
+        logging.getLogger(name).setLevel(logging.ERROR)
+
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
@@ -0,0 +1,354 @@
+import asyncio
+import datetime
+import logging
+import os
+import time
+
+from pyrogram.errors import (
+    FloodWait,
+    UserIsBlocked,
+    ChatWriteForbidden,
+    ChatAdminRequired,
+    ChannelPrivate,
+    InputUserDeactivated,
+    UserDeactivated,
+    UserDeactivatedBan,
+    PeerIdInvalid,
+    ChatIdInvalid,
+    ChannelInvalid,
+)
+
+from metrics import RAISE_FLOOD_WAIT, flood_sleep_threshold
+
+logger = logging.getLogger(__name__)
+
+# --- Broadcast Settings ---
+# Telegram allows bots roughly 30 messages per second across all chats.
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', 25))
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', 10))
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get('BROADCAST_PROGRESS_INTERVAL', 5))
+BROADCAST_CHECKPOINT_BATCH = int(os.environ.get('BROADCAST_CHECKPOINT_BATCH', 200))
+BROADCAST_MAX_FLOOD_RETRIES = 3
+
+RESULT_TYPES = ['sent', 'blocked', 'deactivated', 'not_found', 'other']
+# Failures that will not go away on their own; these recipients are flagged inactive.
+PRUNED_RESULT_TYPES = ['blocked', 'deactivated', 'not_found']
+TARGET_LABELS = {'users': "User", 'channels': "Channel"}
+STATUS_TITLES = {
+    'running': "in progress", 'paused': "paused", 'completed': "complete", 'cancelled': "cancelled", 'failed': "failed",
+}
+
+FAILURE_TYPES = {
+    'blocked': (UserIsBlocked, ChatWriteForbidden, ChatAdminRequired, ChannelPrivate),
+    'deactivated': (InputUserDeactivated, UserDeactivated, UserDeactivatedBan),
+    'not_found': (PeerIdInvalid, ChatIdInvalid, ChannelInvalid),
+}
+
+
+def classify_error(error: Exception) -> str:
+    """Maps a send failure to one of the broadcast result categories."""
+    for failure_type, error_classes in FAILURE_TYPES.items():
+        if isinstance(error, error_classes):
+            return failure_type
+    return 'other'
+
+
+class TokenBucket:
+    """Global send rate limiter that can be paused for a FloodWait."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Stops handing out tokens for `seconds`, e.g. after a FloodWait."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.updated_at = self.paused_until
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+rate_limiter = TokenBucket(BROADCAST_RATE)
+
+
+class Broadcast:
+    """Copies one message to many recipients with a bounded pool of workers.
+
+    Recipients are read in `_id` order in batches of BROADCAST_CHECKPOINT_BATCH.
+    After each batch is fully sent the job's checkpoint, counts and recipient
+    results are written in one go, so a restart re-sends at most one batch.
+    Recipients that failed permanently are flagged inactive at the same time.
+    """
+
+    def __init__(self, client, jobs, job: dict, recipients):
+        self.client = client
+        self.jobs = jobs
+        self.job = job
+        self.recipients = recipients
+        self.label = TARGET_LABELS[job['target']]
+        self.counts = dict(job.get('counts') or {key: 0 for key in RESULT_TYPES})
+        self.batch_results = {key: [] for key in RESULT_TYPES}
+        self.started_at = time.monotonic()
+        self.processed_at_start = self.processed
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.cancelled = False
+        # Fetched once in run(); copying via client.copy_message would fetch it again for every recipient.
+        self.source = None
+
+    @property
+    def processed(self) -> int:
+        return sum(self.counts.values())
+
+    async def send(self, chat_id: int) -> str:
+        """Sends to one recipient and returns the result category."""
+        for _ in range(BROADCAST_MAX_FLOOD_RETRIES + 1):
+            await rate_limiter.acquire()
+            try:
+                await self.source.copy(chat_id)
+                return 'sent'
+            except FloodWait as e:
+                logger.warning(f"FloodWait during {self.label} broadcast: pausing sends for {e.value} seconds.")
+                rate_limiter.pause(e.value)
+            except Exception as e:
+                failure_type = classify_error(e)
+                if failure_type == 'other':
+                    logger.warning(f"Broadcast to {chat_id} failed: {e}")
+                return failure_type
+        return 'other'
+
+    async def fetch_source(self):
+        """Returns the message to broadcast, or None if it has been deleted."""
+        while True:
+            await rate_limiter.acquire()
+            try:
+                message = await self.client.get_messages(self.job['from_chat_id'], self.job['message_id'])
+                return None if message.empty else message
+            except FloodWait as e:
+                rate_limiter.pause(e.value)
+
+    async def worker(self, queue: asyncio.Queue):
+        while True:
+            chat_id = await queue.get()
+            try:
+                await self.resumed.wait()
+                if not self.cancelled:
+                    result = await self.send(chat_id)
+                    self.counts[result] += 1
+                    self.batch_results[result].append(chat_id)
+            finally:
+                queue.task_done()
+
+    async def checkpoint(self, last_id):
+        results = self.batch_results
+        self.batch_results = {key: [] for key in RESULT_TYPES}
+        try:
+            await self.jobs.checkpoint(self.job['_id'], last_id, dict(self.counts), results)
+            await self.recipients.mark_inactive({reason: results[reason] for reason in PRUNED_RESULT_TYPES})
+        except Exception as e:
+            logger.error(f"Failed to checkpoint broadcast {self.job['_id']}: {e}")
+
+    def progress_text(self, status: str = 'running') -> str:
+        elapsed = time.monotonic() - self.started_at
+        rate = (self.processed - self.processed_at_start) / elapsed if elapsed else 0
+        return (
+            f"📣 **{self.label} Broadcast {STATUS_TITLES[status]}**\n"
+            f"Job: `{self.job['_id']}`\n\n"
+            f"Sent: {self.counts['sent']}\n"
+            f"Blocked: {self.counts['blocked']}\n"
+            f"Deactivated: {self.counts['deactivated']}\n"
+            f"Chat not found: {self.counts['not_found']}\n"
+            f"Other errors: {self.counts['other']}\n"
+            f"Speed: {rate:.1f} msgs/s, elapsed {int(elapsed)}s"
+        )
+
+    async def edit_progress(self, text: str):
+        await self.client.edit_message_text(
+            chat_id=self.job['admin_chat_id'],
+            message_id=self.job['progress_message_id'],
+            text=text
+        )
+
+    async def report_progress(self):
+        last_text = None
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            text = self.progress_text('running' if self.resumed.is_set() else 'paused')
+            if text == last_text:
+                continue
+            try:
+                await self.edit_progress(text)
+                last_text = text
+            except FloodWait as e:
+                await asyncio.sleep(e.value)
+            except Exception as e:
+                logger.warning(f"Failed to update broadcast progress: {e}")
+
+    async def run(self):
+        """Sends to every remaining recipient and marks the job completed, cancelled or failed."""
+        # Every FloodWait must pause the bucket rather than block one worker inside the RPC.
+        flood_sleep_threshold.set(RAISE_FLOOD_WAIT)
+        try:
+            self.source = await self.fetch_source()
+        except Exception as e:
+            # e.g. the source chat is private or invalid; retrying on every start would fail the same way.
+            logger.error(f"Broadcast {self.job['_id']} failed: could not fetch its source message: {e}")
+            return await self.finish('failed')
+        if self.source is None:
+            logger.error(f"Broadcast {self.job['_id']} cancelled: its source message no longer exists.")
+            return await self.finish('cancelled')
+        queue = asyncio.Queue(maxsize=BROADCAST_WORKERS * 2)
+        workers = [asyncio.create_task(self.worker(queue)) for _ in range(BROADCAST_WORKERS)]
+        reporter = asyncio.create_task(self.report_progress())
+        last_id = self.job.get('checkpoint')
+        try:
+            async for batch in self.recipients.iter_batches(BROADCAST_CHECKPOINT_BATCH, after_id=last_id):
+                for doc in batch:
+                    await queue.put(doc[self.recipients.id_field])
+                await queue.join()
+                if self.cancelled:
+                    # Record what the partly sent batch did, without moving the checkpoint past it.
+                    await self.checkpoint(last_id)
+                    break
+                last_id = batch[-1]['_id']
+                await self.checkpoint(last_id)
+        finally:
+            for task in workers:
+                task.cancel()
+            reporter.cancel()
+        return await self.finish('cancelled' if self.cancelled else 'completed')
+
+    async def finish(self, status: str):
+        await self.jobs.set_status(self.job['_id'], status)
+        try:
+            await self.edit_progress(self.progress_text(status))
+        except Exception as e:
+            logger.warning(f"Failed to send final broadcast progress: {e}")
+        return self.counts
+
+
+class BroadcastManager:
+    """Creates, resumes and controls persisted broadcast jobs."""
+
+    def __init__(self, db):
+        self.db = db
+        self.active = {}
+
+    def recipients(self, target: str):
+        return self.db.users if target == 'users' else self.db.channels
+
+    async def create(self, client, target: str, source_message, progress_message):
+        """Stores a new job and starts sending it."""
+        job = {
+            'target': target,
+            'from_chat_id': source_message.chat.id,
+            'message_id': source_message.id,
+            'admin_chat_id': progress_message.chat.id,
+            'progress_message_id': progress_message.id,
+            'status': 'running',
+            'checkpoint': None,
+            'counts': {key: 0 for key in RESULT_TYPES},
+            'created_at': datetime.datetime.now(),
+            'updated_at': datetime.datetime.now(),
+        }
+        job['_id'] = await self.db.broadcast_jobs.create(job)
+        return self.start(client, job)
+
+    def start(self, client, job: dict):
+        broadcast = Broadcast(client, self.db.broadcast_jobs, job, self.recipients(job['target']))
+        self.active[job['_id']] = broadcast
+        broadcast.task = asyncio.create_task(broadcast.run())
+        broadcast.task.add_done_callback(lambda task: self.finished(job['_id'], task))
+        return job['_id']
+
+    def finished(self, job_id, task: asyncio.Task):
+        self.active.pop(job_id, None)
+        if not task.cancelled() and task.exception():
+            # The job stays 'running' in Mongo and is picked up again on the next start.
+            logger.error(f"Broadcast {job_id} stopped with an error: {task.exception()}")
+
+    def stop_all(self):
+        """Stops local broadcast tasks without changing their stored status, e.g. when
+        another worker takes over; that worker resumes them from their checkpoints."""
+        for broadcast in list(self.active.values()):
+            broadcast.task.cancel()
+
+    async def resume_unfinished(self, client):
+        """Restarts jobs that were still running when the bot stopped."""
+        for job in await self.db.broadcast_jobs.running():
+            if job['_id'] in self.active:
+                continue
+            logger.info(f"Resuming broadcast {job['_id']} from checkpoint {job.get('checkpoint')}.")
+            self.start(client, job)
+
+    async def pause(self, job_id) -> bool:
+        broadcast = self.active.get(job_id)
+        if not broadcast or not broadcast.resumed.is_set():
+            return False
+        broadcast.resumed.clear()
+        await self.db.broadcast_jobs.set_status(job_id, 'paused')
+        return True
+
+    async def resume(self, client, job_id) -> bool:
+        broadcast = self.active.get(job_id)
+        if broadcast:
+            if broadcast.resumed.is_set():
+                return False
+            await self.db.broadcast_jobs.set_status(job_id, 'running')
+            broadcast.resumed.set()
+            return True
+        # Paused before a restart: continue from the stored checkpoint.
+        job = await self.db.broadcast_jobs.get(job_id)
+        if not job or job['status'] != 'paused':
+            return False
+        await self.db.broadcast_jobs.set_status(job_id, 'running')
+        self.start(client, job)
+        return True
+
+    async def cancel(self, job_id) -> bool:
+        broadcast = self.active.get(job_id)
+        if broadcast:
+            broadcast.cancelled = True
+            broadcast.resumed.set()
+            return True
+        job = await self.db.broadcast_jobs.get(job_id)
+        if not job or job['status'] not in ['running', 'paused']:
+            return False
+        await self.db.broadcast_jobs.set_status(job_id, 'cancelled')
+        return True
+
+    async def status_text(self, job_id=None) -> str:
+        if job_id is not None:
+            broadcast = self.active.get(job_id)
+            if broadcast:
+                return broadcast.progress_text('running' if broadcast.resumed.is_set() else 'paused')
+            jobs = [job for job in [await self.db.broadcast_jobs.get(job_id)] if job]
+        else:
+            jobs = await self.db.broadcast_jobs.recent()
+        if not jobs:
+            return "No broadcast jobs found."
+        lines = ["📣 **Broadcast Jobs**\n"]
+        for job in jobs:
+            counts = job.get('counts') or {}
+            lines.append(
+                f"`{job['_id']}` - {TARGET_LABELS[job['target']]} - {job['status']}\n"
+                f"Sent: {counts.get('sent', 0)}, Failed: {sum(counts.values()) - counts.get('sent', 0)}"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,541 @@
+import asyncio
+import datetime
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from pymongo import ASCENDING, MongoClient, ReturnDocument, UpdateMany
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from metrics import MONGO_LATENCY
+
+logger = logging.getLogger(__name__)
+
+# --- Connection Settings ---
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', 50))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', 0))
+MONGO_TIMEOUT_MS = int(os.environ.get('MONGO_TIMEOUT_MS', 5000))
+# Upper bound on queries running at once; each one holds an executor thread and a pool connection.
+MONGO_EXECUTOR_WORKERS = int(os.environ.get('MONGO_EXECUTOR_WORKERS', 16))
+# Expired premium records are removed by a TTL index this many days after expiry; 0 keeps them forever.
+PREMIUM_RETENTION_DAYS = int(os.environ.get('PREMIUM_RETENTION_DAYS', 30))
+# Handled forwarded messages are remembered in Mongo for this many seconds so redelivered
+# updates are skipped after a restart; 0 keeps the record in memory only.
+DEDUP_PERSIST_WINDOW = int(os.environ.get('DEDUP_PERSIST_WINDOW', 0))
+
+# --- Schema ---
+# collection -> [(keys, options)]; created idempotently on every start.
+INDEXES = {
+    'users': [
+        ([('user_id', ASCENDING)], {'unique': True}),
+        ([('inactive', ASCENDING), ('_id', ASCENDING)], {}),
+    ],
+    'channels': [
+        ([('channel_id', ASCENDING)], {'unique': True}),
+        ([('inactive', ASCENDING), ('_id', ASCENDING)], {}),
+    ],
+    # The compound index also serves queries on `user_id` alone.
+    'user_channels': [
+        ([('user_id', ASCENDING), ('channel_id', ASCENDING)], {'unique': True}),
+        ([('channel_id', ASCENDING)], {}),
+    ],
+    'premium_users': [
+        ([('user_id', ASCENDING)], {'unique': True}),
+        (
+            [('expiry_date', ASCENDING)],
+            {'expireAfterSeconds': PREMIUM_RETENTION_DAYS * 86400} if PREMIUM_RETENTION_DAYS > 0 else {}
+        ),
+    ],
+    'broadcast_jobs': [
+        ([('status', ASCENDING)], {}),
+    ],
+    'broadcast_results': [
+        ([('job_id', ASCENDING)], {}),
+    ],
+    'cache_events': [
+        ([('created_at', ASCENDING)], {'expireAfterSeconds': 3600}),
+    ],
+    # Only used with a persistent window; a plain index here would later block the TTL one.
+    'processed_messages': [
+        ([('handled_at', ASCENDING)], {'expireAfterSeconds': DEDUP_PERSIST_WINDOW}),
+    ] if DEDUP_PERSIST_WINDOW > 0 else [],
+}
+# Server error codes for an existing index with the same keys but different options.
+INDEX_CONFLICT_CODES = (85, 86)
+
+# Recipients a broadcast should reach. Matching exact values (None also matches a missing field)
+# gives point ranges on the (inactive, _id) index, so keyset batches are read in _id order
+# from the index instead of being sorted in memory, as they would be with `$ne: True`.
+ACTIVE_RECIPIENTS = {'inactive': {'$in': [False, None]}}
+
+# name -> (collection, filter, sort) for the queries on the bot's hot paths.
+HOT_QUERIES = {
+    'user by id': ('users', {'user_id': 0}, None),
+    'broadcast users': ('users', ACTIVE_RECIPIENTS, [('_id', ASCENDING)]),
+    'broadcast channels': ('channels', ACTIVE_RECIPIENTS, [('_id', ASCENDING)]),
+    'links by channel': ('user_channels', {'channel_id': 0}, None),
+    'link by user+channel': ('user_channels', {'user_id': 0, 'channel_id': 0}, None),
+    'links by user': ('user_channels', {'user_id': 0}, None),
+    'premium by user': ('premium_users', {'user_id': 0}, None),
+    'active premium': ('premium_users', {'expiry_date': {'$gt': datetime.datetime(2000, 1, 1)}}, None),
+    'running broadcasts': ('broadcast_jobs', {'status': 'running'}, None),
+}
+
+
+class AsyncCollection:
+    """Runs blocking PyMongo collection calls on a bounded thread pool."""
+
+    def __init__(self, collection, executor: ThreadPoolExecutor):
+        self.collection = collection
+        self.executor = executor
+
+    async def execute(self, operation: str, call):
+        """Runs `call` on the executor and records its latency under `operation`."""
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+        finally:
+            MONGO_LATENCY.labels(self.collection.name, operation).observe(time.perf_counter() - start)
+
+    async def run(self, method: str, *args, **kwargs):
+        return await self.execute(method, partial(getattr(self.collection, method), *args, **kwargs))
+
+    async def find_one(self, *args, **kwargs):
+        return await self.run('find_one', *args, **kwargs)
+
+    async def insert_one(self, *args, **kwargs):
+        return await self.run('insert_one', *args, **kwargs)
+
+    async def insert_many(self, *args, **kwargs):
+        return await self.run('insert_many', *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await self.run('update_one', *args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return await self.run('delete_one', *args, **kwargs)
+
+    async def delete_many(self, *args, **kwargs):
+        return await self.run('delete_many', *args, **kwargs)
+
+    async def count_documents(self, *args, **kwargs):
+        return await self.run('count_documents', *args, **kwargs)
+
+    async def distinct(self, *args, **kwargs):
+        return await self.run('distinct', *args, **kwargs)
+
+    async def aggregate(self, pipeline: list) -> list:
+        def fetch():
+            return list(self.collection.aggregate(pipeline))
+        return await self.execute('aggregate', fetch)
+
+    async def explain(self, query: dict, sort=None) -> dict:
+        def fetch():
+            cursor = self.collection.find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            return cursor.explain()
+        return await self.execute('explain', fetch)
+
+    async def find_list(self, query: dict, limit: int = 0, sort=None, projection=None) -> list:
+        """Runs a find and materializes the results on the executor thread."""
+        def fetch():
+            cursor = self.collection.find(query, projection, limit=limit)
+            if sort:
+                cursor = cursor.sort(sort)
+            return list(cursor)
+        return await self.execute('find', fetch)
+
+    async def iter_batches(self, query: dict, batch_size: int = 500, projection=None, after_id=None):
+        """Yields lists of documents in `_id` order, one query per batch.
+
+        Paging by `_id` instead of holding a cursor open keeps each executor call
+        short and lets callers resume from the last `_id` they processed.
+        """
+        while True:
+            page_query = dict(query)
+            if after_id is not None:
+                page_query['_id'] = {'$gt': after_id}
+            batch = await self.find_list(page_query, limit=batch_size, sort=[('_id', 1)], projection=projection)
+            if not batch:
+                return
+            yield batch
+            if len(batch) < batch_size:
+                return
+            after_id = batch[-1]['_id']
+
+
+def is_active(premium_doc) -> bool:
+    return bool(premium_doc) and premium_doc['expiry_date'] > datetime.datetime.now()
+
+
+# --- Repositories ---
+class CounterRepository:
+    """Aggregate counters kept up to date by the other repositories.
+
+    The `totals` document holds the user, channel, channel link and active
+    premium counts shown by /stats. They are only eventually correct, so limits
+    are checked against the source collections instead. `reconcile` recomputes
+    them to correct drift, e.g. premium subscriptions that expired since the
+    last run.
+    """
+
+    def __init__(self, collection: AsyncCollection):
+        self.collection = collection
+
+    async def increment(self, field: str, amount: int = 1):
+        await self.collection.update_one({'_id': 'totals'}, {'$inc': {field: amount}}, upsert=True)
+
+    async def totals(self):
+        return await self.collection.find_one({'_id': 'totals'})
+
+    async def reconcile(self, db):
+        """Recomputes every counter from the source collections."""
+        totals = {
+            'users': await db.users.collection.count_documents({}),
+            'channels': await db.channels.collection.count_documents({}),
+            'channel_links': await db.user_channels.collection.count_documents({}),
+            'premium_active': await db.premium.count_active(),
+            'reconciled_at': datetime.datetime.now(),
+        }
+        await self.collection.update_one({'_id': 'totals'}, {'$set': totals}, upsert=True)
+        return totals
+
+
+class RecipientRepository:
+    """Shared broadcast-recipient behaviour for users and channels.
+
+    Recipients that fail with a permanent error are flagged `inactive` and
+    skipped by later broadcasts until they are upserted again.
+    """
+
+    id_field = None
+    counter_field = None
+
+    def __init__(self, collection: AsyncCollection, counters: CounterRepository):
+        self.collection = collection
+        self.counters = counters
+
+    async def upsert(self, doc: dict):
+        result = await self.collection.update_one(
+            {self.id_field: doc[self.id_field]},
+            {'$set': {**doc, 'inactive': False}, '$unset': {'inactive_reason': '', 'inactive_since': ''}},
+            upsert=True
+        )
+        if result.upserted_id is not None:
+            await self.counters.increment(self.counter_field)
+        return result
+
+    def iter_batches(self, batch_size: int = 500, after_id=None):
+        return self.collection.iter_batches(
+            ACTIVE_RECIPIENTS, batch_size, projection={self.id_field: 1}, after_id=after_id
+        )
+
+    async def mark_inactive(self, ids_by_reason: dict):
+        """Flags recipients as inactive with one bulk write; `ids_by_reason` maps a reason to IDs."""
+        now = datetime.datetime.now()
+        operations = [
+            UpdateMany(
+                {self.id_field: {'$in': ids}},
+                {'$set': {'inactive': True, 'inactive_reason': reason, 'inactive_since': now}}
+            )
+            for reason, ids in ids_by_reason.items() if ids
+        ]
+        if operations:
+            await self.collection.run('bulk_write', operations, ordered=False)
+
+    async def inactive_counts(self) -> dict:
+        pipeline = [
+            {'$match': {'inactive': True}},
+            {'$group': {'_id': '$inactive_reason', 'count': {'$sum': 1}}},
+        ]
+        return {row['_id']: row['count'] for row in await self.collection.aggregate(pipeline)}
+
+
+class UserRepository(RecipientRepository):
+    id_field = 'user_id'
+    counter_field = 'users'
+
+    async def get(self, user_id: int):
+        return await self.collection.find_one({'user_id': user_id})
+
+
+class ChannelRepository(RecipientRepository):
+    id_field = 'channel_id'
+    counter_field = 'channels'
+
+
+class PremiumRepository:
+    def __init__(self, collection: AsyncCollection, counters: CounterRepository):
+        self.collection = collection
+        self.counters = counters
+
+    async def get(self, user_id: int):
+        return await self.collection.find_one({'user_id': user_id})
+
+    async def grant(self, user_id: int, expiry_date: datetime.datetime, admin_id: int):
+        previous = await self.collection.run(
+            'find_one_and_update',
+            {'user_id': user_id},
+            {'$set': {'expiry_date': expiry_date, 'added_by_admin': admin_id}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        if not is_active(previous):
+            await self.counters.increment('premium_active')
+
+    async def revoke(self, user_id: int) -> bool:
+        removed = await self.collection.run('find_one_and_delete', {'user_id': user_id})
+        if is_active(removed):
+            await self.counters.increment('premium_active', -1)
+        return removed is not None
+
+    async def count_active(self) -> int:
+        return await self.collection.count_documents({'expiry_date': {'$gt': datetime.datetime.now()}})
+
+    async def page(self, after_id=None, before_id=None, limit: int = 10):
+        """Returns one page of premium users in `_id` order and whether more exist in that direction."""
+        if before_id is not None:
+            docs = await self.collection.find_list({'_id': {'$lt': before_id}}, limit=limit + 1, sort=[('_id', -1)])
+            return list(reversed(docs[:limit])), len(docs) > limit
+        query = {'_id': {'$gt': after_id}} if after_id is not None else {}
+        docs = await self.collection.find_list(query, limit=limit + 1, sort=[('_id', 1)])
+        return docs[:limit], len(docs) > limit
+
+
+class UserChannelRepository:
+    def __init__(self, collection: AsyncCollection, counters: CounterRepository):
+        self.collection = collection
+        self.counters = counters
+
+    async def link(self, user_channel_doc: dict):
+        result = await self.collection.update_one(
+            {'user_id': user_channel_doc['user_id'], 'channel_id': user_channel_doc['channel_id']},
+            {'$set': user_channel_doc},
+            upsert=True
+        )
+        if result.upserted_id is not None:
+            await self.counters.increment('channel_links')
+        return result
+
+    async def unlink(self, user_id: int, channel_id: int) -> bool:
+        result = await self.collection.delete_one({'user_id': user_id, 'channel_id': channel_id})
+        if result.deleted_count > 0:
+            await self.counters.increment('channel_links', -1)
+        return result.deleted_count > 0
+
+    async def count_for_user(self, user_id: int) -> int:
+        # Enforces the free channel limit, so it reads the links rather than the counters.
+        return await self.collection.count_documents({'user_id': user_id})
+
+    async def is_linked(self, channel_id: int) -> bool:
+        return await self.collection.find_one({'channel_id': channel_id}, {'_id': 1}) is not None
+
+    async def channel_ids(self) -> list:
+        return await self.collection.distinct('channel_id')
+
+
+class BroadcastJobRepository:
+    """Persisted broadcast jobs, their checkpoints and per-batch recipient results."""
+
+    def __init__(self, jobs: AsyncCollection, results: AsyncCollection):
+        self.jobs = jobs
+        self.results = results
+
+    async def create(self, job_doc: dict):
+        result = await self.jobs.insert_one(job_doc)
+        return result.inserted_id
+
+    async def get(self, job_id):
+        return await self.jobs.find_one({'_id': job_id})
+
+    async def set_status(self, job_id, status: str):
+        return await self.jobs.update_one(
+            {'_id': job_id},
+            {'$set': {'status': status, 'updated_at': datetime.datetime.now()}}
+        )
+
+    async def checkpoint(self, job_id, last_id, counts: dict, results: dict):
+        """Stores one batch of recipient results and advances the job's checkpoint."""
+        now = datetime.datetime.now()
+        await self.results.insert_one({'job_id': job_id, 'last_id': last_id, 'results': results, 'created_at': now})
+        await self.jobs.update_one(
+            {'_id': job_id},
+            {'$set': {'checkpoint': last_id, 'counts': counts, 'updated_at': now}}
+        )
+
+    async def running(self) -> list:
+        return await self.jobs.find_list({'status': 'running'})
+
+    async def recent(self, limit: int = 5) -> list:
+        return await self.jobs.find_list({}, limit=limit, sort=[('_id', -1)])
+
+
+class LeaseRepository:
+    """Time-limited ownership records used to coordinate shard worker processes."""
+
+    def __init__(self, collection: AsyncCollection):
+        self.collection = collection
+
+    async def acquire(self, lease_id: str, owner: str, ttl: float) -> bool:
+        """Takes or renews a lease; fails while another owner holds an unexpired lease."""
+        now = datetime.datetime.utcnow()
+        try:
+            await self.collection.run(
+                'find_one_and_update',
+                {'_id': lease_id, '$or': [{'owner': owner}, {'expires_at': {'$lt': now}}]},
+                {'$set': {'owner': owner, 'expires_at': now + datetime.timedelta(seconds=ttl)}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            # The lease exists and belongs to someone else, so the upsert's insert collided.
+            return False
+
+    async def release(self, lease_id: str, owner: str):
+        await self.collection.delete_one({'_id': lease_id, 'owner': owner})
+
+    async def get(self, lease_id: str):
+        return await self.collection.find_one({'_id': lease_id})
+
+
+class CacheEventRepository:
+    """Cache invalidations published by one shard worker for the others to apply."""
+
+    def __init__(self, collection: AsyncCollection):
+        self.collection = collection
+
+    async def publish(self, cache: str, key, worker: str):
+        await self.collection.insert_one(
+            {'cache': cache, 'key': key, 'worker': worker, 'created_at': datetime.datetime.utcnow()}
+        )
+
+    async def since(self, created_after: datetime.datetime) -> list:
+        return await self.collection.find_list({'created_at': {'$gt': created_after}}, sort=[('created_at', 1)])
+
+
+class ProcessedMessageRepository:
+    """Messages already handled, keyed by "<chat_id>:<message_id>" and expired by a TTL index."""
+
+    def __init__(self, collection: AsyncCollection):
+        self.collection = collection
+
+    async def claim(self, chat_id: int, message_id: int) -> bool:
+        """Records the message as handled; returns False if it already was."""
+        try:
+            await self.collection.insert_one({'_id': f"{chat_id}:{message_id}", 'handled_at': datetime.datetime.utcnow()})
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def release(self, chat_id: int, message_ids: list):
+        """Forgets messages whose handling did not finish, so a redelivery is handled again."""
+        await self.collection.delete_many({'_id': {'$in': [f"{chat_id}:{message_id}" for message_id in message_ids]}})
+
+
+def collect_plan_stages(plan, stages: list, index_names: list):
+    """Walks an explain() plan tree and collects its stage and index names."""
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        if 'indexName' in plan:
+            index_names.append(plan['indexName'])
+        for value in plan.values():
+            collect_plan_stages(value, stages, index_names)
+    elif isinstance(plan, list):
+        for item in plan:
+            collect_plan_stages(item, stages, index_names)
+
+
+class Database:
+    """Async data layer over the bot's MongoDB collections.
+
+    A `mongomock://` URI uses an in-memory stand-in (requires the optional
+    `mongomock` package), which is handy for local testing and benchmarks.
+    """
+
+    def __init__(self, uri: str, db_name: str = 'bot_database'):
+        if uri.startswith('mongomock://'):
+            import mongomock
+            self.client = mongomock.MongoClient()
+        else:
+            self.client = MongoClient(
+                uri,
+                maxPoolSize=MONGO_MAX_POOL_SIZE,
+                minPoolSize=MONGO_MIN_POOL_SIZE,
+                serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+            )
+        self.executor = ThreadPoolExecutor(max_workers=MONGO_EXECUTOR_WORKERS, thread_name_prefix='mongo')
+        self.db = self.client.get_database(db_name)
+        self.counters = CounterRepository(self.collection('counters'))
+        self.users = UserRepository(self.collection('users'), self.counters)
+        self.channels = ChannelRepository(self.collection('channels'), self.counters)
+        self.premium = PremiumRepository(self.collection('premium_users'), self.counters)
+        self.user_channels = UserChannelRepository(self.collection('user_channels'), self.counters)
+        self.leases = LeaseRepository(self.collection('shard_leases'))
+        self.cache_events = CacheEventRepository(self.collection('cache_events'))
+        self.processed_messages = ProcessedMessageRepository(self.collection('processed_messages'))
+        self.broadcast_jobs = BroadcastJobRepository(self.collection('broadcast_jobs'), self.collection('broadcast_results'))
+
+    def collection(self, name: str) -> AsyncCollection:
+        return AsyncCollection(self.db.get_collection(name), self.executor)
+
+    async def ensure_indexes(self):
+        """Creates the indexes in INDEXES. Safe to run on every start.
+
+        An existing index whose options changed (e.g. a new TTL setting) is
+        updated in place. Other failures, such as duplicate data blocking a
+        unique index, are logged and the remaining indexes are still created.
+        """
+        for name, indexes in INDEXES.items():
+            collection = self.collection(name)
+            for keys, options in indexes:
+                try:
+                    try:
+                        await collection.run('create_index', keys, **options)
+                    except OperationFailure as e:
+                        if e.code not in INDEX_CONFLICT_CODES:
+                            raise
+                        await self.update_index_options(collection, name, keys, options)
+                except OperationFailure as e:
+                    logger.error(f"Failed to create index {keys} on {name}: {e}")
+
+    async def update_index_options(self, collection: AsyncCollection, name: str, keys: list, options: dict):
+        """Brings an existing index on `keys` in line with `options`.
+
+        A changed TTL is applied with collMod; any other change (adding or
+        removing the TTL, uniqueness) drops and rebuilds the index.
+        """
+        info = await collection.run('index_information')
+        existing_name, existing = next((index_name, index) for index_name, index in info.items() if index['key'] == keys)
+        if 'expireAfterSeconds' in existing and 'expireAfterSeconds' in options:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, partial(
+                self.db.command, 'collMod', name,
+                index={'keyPattern': dict(keys), 'expireAfterSeconds': options['expireAfterSeconds']}
+            ))
+            logger.info(f"Updated the TTL of index {existing_name} on {name} to {options['expireAfterSeconds']}s.")
+            return
+        await collection.run('drop_index', existing_name)
+        await collection.run('create_index', keys, **options)
+        logger.info(f"Rebuilt index {existing_name} on {name} with options {options}.")
+
+    async def explain_hot_queries(self) -> list:
+        """Explains every query in HOT_QUERIES and returns (name, stages, index names) tuples."""
+        report = []
+        for name, (collection_name, query, sort) in HOT_QUERIES.items():
+            plan = await self.collection(collection_name).explain(query, sort)
+            stages, index_names = [], []
+            collect_plan_stages(plan.get('queryPlanner', {}).get('winningPlan', {}), stages, index_names)
+            report.append((name, stages, index_names))
+        return report
+
+    async def ping(self):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.client.admin.command, 'ping')
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.client.close()
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import os
+
+from pyrogram.errors import FloodWait
+
+logger = logging.getLogger(__name__)
+
+# --- Log Sink Settings ---
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 10))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 500))
+MAX_MESSAGE_LENGTH = 4096
+
+# Lower values are more important and are kept longest when the queue is full.
+PRIORITY_ERROR = 0
+PRIORITY_WARNING = 1
+PRIORITY_INFO = 2
+
+
+class LogSink:
+    """Collects log channel events and sends them in periodic batches.
+
+    Identical events within one flush window are merged into a single line
+    with a repeat count. When more than LOG_QUEUE_SIZE distinct events are
+    pending, the least important ones are dropped instead of queued.
+    """
+
+    def __init__(self, chat_id: int, flush_interval: float = LOG_FLUSH_INTERVAL, max_size: int = LOG_QUEUE_SIZE):
+        self.chat_id = chat_id
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        # text -> [repeat count, priority]; dicts keep insertion order, so events are sent in order.
+        self.pending = {}
+        self.dropped = 0
+
+    def emit(self, text: str, priority: int = PRIORITY_INFO):
+        """Queues an event. Never blocks and never talks to Telegram."""
+        entry = self.pending.get(text)
+        if entry:
+            entry[0] += 1
+            return
+        if len(self.pending) >= self.max_size and not self.evict(priority):
+            self.dropped += 1
+            return
+        self.pending[text] = [1, priority]
+
+    def evict(self, priority: int) -> bool:
+        """Drops the newest, least important pending event if it is less important than `priority`."""
+        victim = None
+        for text, (_, entry_priority) in self.pending.items():
+            if entry_priority > priority and (victim is None or entry_priority >= self.pending[victim][1]):
+                victim = text
+        if victim is None:
+            return False
+        del self.pending[victim]
+        self.dropped += 1
+        return True
+
+    def take_chunks(self) -> list:
+        """Empties the queue into message texts that fit Telegram's length limit."""
+        lines = []
+        for text, (count, _) in self.pending.items():
+            line = f"{text}\n(repeated {count}x)" if count > 1 else text
+            lines.append(line[:MAX_MESSAGE_LENGTH])
+        if self.dropped:
+            lines.append(f"⚠️ {self.dropped} log events dropped because the log queue was full.")
+        self.pending = {}
+        self.dropped = 0
+
+        chunks = []
+        current = ""
+        for line in lines:
+            if current and len(current) + len(line) + 2 > MAX_MESSAGE_LENGTH:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n\n{line}" if current else line
+        if current:
+            chunks.append(current)
+        return chunks
+
+    async def flush(self, client):
+        for chunk in self.take_chunks():
+            while True:
+                try:
+                    await client.send_message(chat_id=self.chat_id, text=chunk)
+                    break
+                except FloodWait as e:
+                    await asyncio.sleep(e.value)
+                except Exception as e:
+                    logger.error(f"Failed to send log message to channel {self.chat_id}: {e}")
+                    break
+
+    async def run(self, client):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush(client)
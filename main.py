@@ -1,19 +1,50 @@
+# Taken before the other imports so that their cost is part of startup_timings['imports'].
+import time
+startup_timings = {'started': time.perf_counter()}
+
 import logging
 import os
 import datetime
 from datetime import timedelta
 import asyncio
-from pymongo import MongoClient
-from pyrogram import Client, filters
+import json
+from functools import partial
+from pyrogram import filters, idle
 from pyrogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     Message,
 )
 from pyrogram.enums import ChatType, ChatMemberStatus
-from pyrogram.errors import UserIsBlocked, RPCError, FloodWait
-from flask import Flask
+from pyrogram.errors import (
+    RPCError,
+    FloodWait,
+    ChatAdminRequired,
+    ChatWriteForbidden,
+    MessageDeleteForbidden,
+    UserNotParticipant,
+)
 from threading import Thread
+from bson import ObjectId
+from bson.errors import InvalidId
+from database import Database, DEDUP_PERSIST_WINDOW
+from broadcast import BroadcastManager
+from scheduler import ChannelScheduler
+from metrics import (
+    InstrumentedClient,
+    instrument_handler,
+    monitor_event_loop,
+    loop_heartbeat,
+    render_metrics,
+    CHANNEL_QUEUE_DEPTH,
+    CHANNELS_PARKED,
+)
+from log_sink import LogSink, PRIORITY_ERROR, PRIORITY_WARNING, PRIORITY_INFO
+from web_server import WebServer
+from ttl_cache import TTLCache, MISSING
+from sharding import CacheSync, ShardCoordinator, SHARD_COUNT, SHARD_ID
+
+startup_timings['imports'] = time.perf_counter() - startup_timings['started']
 
 # Set up logging
 logging.basicConfig(
@@ -40,66 +71,305 @@ except (ValueError, TypeError) as e:
 
 # Connect to MongoDB
 try:
-    db_client = MongoClient(MONGO_URI)
-    db = db_client.get_database('bot_database')
-    users_collection = db.get_collection('users')
-    channels_collection = db.get_collection('channels')
-    premium_users_collection = db.get_collection('premium_users')
-    user_channels_collection = db.get_collection('user_channels')
+    db = Database(MONGO_URI)
     logger.info("Connected to MongoDB successfully.")
 except Exception as e:
     logger.error(f"Failed to connect to MongoDB: {e}")
     exit(1)
 
 # Initialize Pyrogram Client
-app = Client(
-    "forward_tag_remover",
+app = InstrumentedClient(
+    # Each shard worker needs its own session file.
+    "forward_tag_remover" if SHARD_COUNT == 1 else f"forward_tag_remover_{SHARD_ID}",
     api_id=API_ID,
     api_hash=API_HASH,
     bot_token=BOT_TOKEN,
 )
 
-# --- Flask App for Render ---
-web_app = Flask(__name__)
+# --- Web Server for Render ---
+# "asyncio" serves the routes from the bot's own event loop; "flask" runs them
+# in a Flask thread instead and needs the optional flask package.
+WEB_SERVER = os.environ.get('WEB_SERVER', 'asyncio')
+WEB_PORT = int(os.environ.get('PORT', 5000))
+HEALTH_MAX_LOOP_LAG = float(os.environ.get('HEALTH_MAX_LOOP_LAG', 2))
 
-@web_app.route('/')
-def home():
-    return "Bot is running OK!"
+async def health_status():
+    """Returns (healthy, details) for the event loop and MongoDB."""
+    details = {}
+    last_tick = loop_heartbeat['last_tick']
+    # A heartbeat that stopped arriving means the loop is blocked (or not running yet).
+    stalled_for = time.monotonic() - last_tick if last_tick else None
+    details['event_loop_lag'] = loop_heartbeat['lag']
+    loop_ok = stalled_for is not None and stalled_for < HEALTH_MAX_LOOP_LAG + 1 and loop_heartbeat['lag'] < HEALTH_MAX_LOOP_LAG
+    details['event_loop'] = "ok" if loop_ok else "stalled"
+    try:
+        await asyncio.wait_for(db.ping(), timeout=5)
+        details['mongo'] = "ok"
+    except Exception as e:
+        details['mongo'] = f"error: {e!r}"
+    return loop_ok and details['mongo'] == "ok", details
+
+async def home_route():
+    return 200, 'text/plain; charset=utf-8', "Bot is running OK!"
+
+async def metrics_route():
+    body, content_type = render_metrics()
+    return 200, content_type, body
+
+async def healthz_route():
+    healthy, details = await health_status()
+    return 200 if healthy else 503, 'application/json', json.dumps(details)
+
+WEB_ROUTES = {
+    '/': home_route,
+    '/metrics': metrics_route,
+    '/healthz': healthz_route,
+}
 
 def run_flask_app():
-    port = int(os.environ.get('PORT', 5000))
-    web_app.run(host='0.0.0.0', port=port)
+    """Serves WEB_ROUTES with Flask; each route still runs on the bot's event loop."""
+    from concurrent.futures import TimeoutError as FutureTimeoutError
+    from flask import Flask
+
+    web_app = Flask(__name__)
+
+    def make_view(route):
+        def view():
+            try:
+                future = asyncio.run_coroutine_threadsafe(route(), app.loop)
+                status, content_type, body = future.result(timeout=10)
+            except FutureTimeoutError:
+                status, content_type, body = 503, 'text/plain; charset=utf-8', "Event loop is not responding"
+            return body, status, {'Content-Type': content_type}
+        return view
+
+    for path, route in WEB_ROUTES.items():
+        web_app.add_url_rule(path, route.__name__, make_view(route))
+    web_app.run(host='0.0.0.0', port=WEB_PORT)
+
+broadcasts = BroadcastManager(db)
+coordinator = ShardCoordinator(db.leases)
+# Each shard worker keeps its own caches; changes handled on one worker are published to the others.
+cache_sync = CacheSync(db.cache_events, coordinator)
+log_sink = LogSink(LOG_CHANNEL_ID)
 
 # --- Helper Functions ---
-async def log_event(client, log_message: str):
-    """Sends a log message to the log channel."""
-    try:
-        await client.send_message(chat_id=LOG_CHANNEL_ID, text=log_message)
-    except Exception as e:
-        logger.error(f"Failed to send log message to channel {LOG_CHANNEL_ID}: {e}")
+def log_event(log_message: str, priority: int = PRIORITY_INFO):
+    """Queues a log message for the log channel; it is sent with the next batch."""
+    log_sink.emit(log_message, priority)
+
+# user ID -> premium expiry date, or None for non-premium users. Entries are trusted for at
+# most PREMIUM_CACHE_TTL seconds so changes made by other instances are picked up.
+premium_cache = TTLCache(ttl=int(os.environ.get('PREMIUM_CACHE_TTL', 600)))
+
+async def sweep_caches():
+    while True:
+        await asyncio.sleep(60)
+        for cache in (premium_cache, bot_permissions, membership_cache, handled_messages):
+            cache.sweep()
 
 async def is_user_premium(user_id: int) -> bool:
     """Checks if a user has an active premium subscription."""
-    premium_user = premium_users_collection.find_one({'user_id': user_id})
-    if premium_user and premium_user['expiry_date'] > datetime.datetime.now():
-        return True
-    return False
+    expiry_date = premium_cache.get(user_id)
+    if expiry_date is MISSING:
+        premium_user = await db.premium.get(user_id)
+        expiry_date = premium_user['expiry_date'] if premium_user else None
+        premium_cache.set(user_id, expiry_date)
+    return expiry_date is not None and expiry_date > datetime.datetime.now()
+
+# --- Channel Registry ---
+class ChannelRegistry:
+    """In-memory set of registered channel IDs used to filter incoming messages."""
+
+    def __init__(self):
+        self.channel_ids = set()
+        self.lookups_saved = 0
+        # channel ID -> registered, for changes made while `load` is reading MongoDB
+        self.changes_during_load = None
+
+    async def load(self):
+        """Replaces the registry contents with the channels stored in MongoDB.
+
+        Channels added or removed while the query runs may be missing from its
+        result, so those changes are applied again on top of it.
+        """
+        self.changes_during_load = {}
+        try:
+            channel_ids = set(await db.user_channels.channel_ids())
+            for channel_id, registered in self.changes_during_load.items():
+                if registered:
+                    channel_ids.add(channel_id)
+                else:
+                    channel_ids.discard(channel_id)
+            self.channel_ids = channel_ids
+        finally:
+            self.changes_during_load = None
+        logger.info(f"Channel registry loaded with {len(self.channel_ids)} channels.")
+
+    def update(self, channel_id: int, registered: bool):
+        if registered:
+            self.channel_ids.add(channel_id)
+        else:
+            self.channel_ids.discard(channel_id)
+        if self.changes_during_load is not None:
+            self.changes_during_load[channel_id] = registered
+
+    def add(self, channel_id: int):
+        self.update(channel_id, True)
+
+    async def discard(self, channel_id: int):
+        # Another user may still have the same channel linked to their account.
+        if not await db.user_channels.is_linked(channel_id):
+            self.update(channel_id, False)
+
+    async def refresh(self, channel_id: int):
+        """Re-reads a single channel after another worker linked or unlinked it."""
+        self.update(channel_id, await db.user_channels.is_linked(channel_id))
+
+    def __contains__(self, channel_id: int) -> bool:
+        self.lookups_saved += 1
+        return channel_id in self.channel_ids
+
+channel_registry = ChannelRegistry()
+CHANNEL_RESYNC_INTERVAL = int(os.environ.get('CHANNEL_RESYNC_INTERVAL', 300))
+
+async def resync_channel_registry():
+    """Periodically reloads the registry so channels added by other instances are picked up."""
+    while True:
+        await asyncio.sleep(CHANNEL_RESYNC_INTERVAL)
+        try:
+            await channel_registry.load()
+        except Exception as e:
+            logger.error(f"Failed to resync channel registry: {e}")
+
+async def invalidate_premium(user_id: int):
+    premium_cache.invalidate(user_id)
+
+async def invalidate_membership(user_id: int):
+    membership_cache.invalidate(user_id)
+
+cache_sync.on('channels', channel_registry.refresh)
+cache_sync.on('premium', invalidate_premium)
+cache_sync.on('membership', invalidate_membership)
+
+registered_channel = filters.create(lambda _, __, m: bool(m.chat) and m.chat.id in channel_registry)
+
+# --- Bot Permission Cache ---
+class BotPermissionCache(TTLCache):
+    """TTL cache of whether the bot can delete messages in each channel."""
+
+    def __init__(self, ttl: float):
+        super().__init__(ttl)
+        # Last known state per channel, kept past expiry so warnings fire only on changes.
+        self.known_states = {}
+
+    def set(self, channel_id: int, can_delete: bool) -> bool:
+        """Stores the permission and returns True if it differs from the last known state."""
+        super().set(channel_id, can_delete)
+        changed = self.known_states.get(channel_id) != can_delete
+        self.known_states[channel_id] = can_delete
+        return changed
+
+bot_permissions = BotPermissionCache(ttl=int(os.environ.get('BOT_PERMISSION_TTL', 600)))
+
+# --- Force Subscribe Membership Cache ---
+MEMBER_STATUSES = [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]
+
+class MembershipCache(TTLCache):
+    """Caches whether users have joined FORCE_SUBSCRIBE_CHANNEL.
+
+    Members are cached for `positive_ttl` seconds and non-members for the
+    shorter `negative_ttl`, so a user who just joined is not kept waiting.
+    Concurrent lookups for the same user share a single get_chat_member call.
+    """
+
+    def __init__(self, positive_ttl: float, negative_ttl: float):
+        super().__init__(positive_ttl)
+        self.negative_ttl = negative_ttl
+        self.in_flight = {}
+
+    def set(self, user_id: int, is_member: bool):
+        super().set(user_id, is_member, None if is_member else self.negative_ttl)
+
+    async def fetch(self, client, user_id: int) -> bool:
+        try:
+            member = await client.get_chat_member(FORCE_SUBSCRIBE_CHANNEL, user_id)
+            is_member = member.status in MEMBER_STATUSES
+        except UserNotParticipant:
+            is_member = False
+        except RPCError as e:
+            logger.warning(f"Could not check channel membership for user {user_id}: {e}")
+            return False
+        except Exception as e:
+            logger.error(f"Unexpected error during membership check: {e}")
+            return False
+        self.set(user_id, is_member)
+        return is_member
+
+    async def is_member(self, client, user_id: int, recheck_negative: bool = False) -> bool:
+        """Returns the cached membership; `recheck_negative` asks Telegram again for cached non-members."""
+        is_member = self.get(user_id)
+        if is_member is not MISSING and (is_member or not recheck_negative):
+            return is_member
+        task = self.in_flight.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self.fetch(client, user_id))
+            self.in_flight[user_id] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(user_id, None))
+        return await asyncio.shield(task)
+
+membership_cache = MembershipCache(
+    positive_ttl=int(os.environ.get('MEMBERSHIP_CACHE_TTL', 3600)),
+    negative_ttl=int(os.environ.get('MEMBERSHIP_NEGATIVE_TTL', 10)),
+)
+
+def can_bot_delete(member) -> bool:
+    """Checks if a ChatMember object for the bot allows removing forward tags."""
+    return (
+        member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]
+        and bool(member.privileges and member.privileges.can_delete_messages)
+    )
+
+
+# --- Shard Routing ---
+# The admin's private chat decides which worker runs broadcasts and other singleton jobs,
+# so broadcast commands always reach the worker that holds the running jobs.
+async def shard_slot_acquired(slot: int):
+    # Slots taken before the client is up are resumed by run_bot once it has started.
+    if slot == coordinator.slot_for(ADMIN_ID) and app.is_initialized:
+        await broadcasts.resume_unfinished(app)
+
+async def shard_slot_released(slot: int):
+    if slot == coordinator.slot_for(ADMIN_ID):
+        broadcasts.stop_all()
+
+coordinator.on_acquire.append(shard_slot_acquired)
+coordinator.on_release.append(shard_slot_released)
+
+@app.on_message(group=-1)
+async def shard_gate_message(client, message: Message):
+    if message.chat and not coordinator.owns(message.chat.id):
+        message.stop_propagation()
+
+@app.on_callback_query(group=-1)
+async def shard_gate_callback(client, query):
+    chat_id = query.message.chat.id if query.message else query.from_user.id
+    if not coordinator.owns(chat_id):
+        query.stop_propagation()
+
+@app.on_chat_member_updated(group=-1)
+async def shard_gate_member_update(client, update):
+    if not coordinator.owns(update.chat.id):
+        update.stop_propagation()
 
 # --- Bot Commands and Handlers ---
 @app.on_message(filters.command("start") & filters.private)
+@instrument_handler
 async def start_command(client, message: Message):
     user = message.from_user
     
     # Check for force subscription
-    is_member = False
-    try:
-        member = await client.get_chat_member(FORCE_SUBSCRIBE_CHANNEL, user.id)
-        if member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
-            is_member = True
-    except RPCError as e:
-        logger.warning(f"Could not check channel membership for user {user.id}: {e}")
-    except Exception as e:
-        logger.error(f"Unexpected error during membership check: {e}")
+    is_member = await membership_cache.is_member(client, user.id)
 
     if not is_member:
         await message.reply_text(
@@ -119,7 +389,7 @@ async def start_command(client, message: Message):
         'first_name': user.first_name,
         'joined': datetime.datetime.now()
     }
-    users_collection.update_one({'user_id': user.id}, {'$set': user_doc}, upsert=True)
+    await db.users.upsert(user_doc)
     
     log_message = (
         f"**New User Started Bot!** 👤\n"
@@ -128,7 +398,7 @@ async def start_command(client, message: Message):
         f"Name: {user.first_name}\n"
         f"Time: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
     )
-    await log_event(client, log_message)
+    log_event(log_message)
     logger.info(f"User started the bot: {user.id}")
 
     main_keyboard = [
@@ -142,6 +412,7 @@ async def start_command(client, message: Message):
     )
 
 @app.on_message(filters.command("addchannel") & filters.private)
+@instrument_handler
 async def addchannel_command(client, message: Message):
     user_id = message.from_user.id
     if len(message.command) < 2:
@@ -156,7 +427,7 @@ async def addchannel_command(client, message: Message):
 
     # Check if the user is a creator or admin of the channel
     try:
-        member = await client.get_chat_member(channel_id, user.id)
+        member = await client.get_chat_member(channel_id, user_id)
         if member.status not in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
             await message.reply_text("You must be an admin of the channel to add it.")
             return
@@ -166,7 +437,7 @@ async def addchannel_command(client, message: Message):
 
     is_premium = await is_user_premium(user_id)
     if not is_premium:
-        channel_count = user_channels_collection.count_documents({'user_id': user_id})
+        channel_count = await db.user_channels.count_for_user(user_id)
         if channel_count >= 2:
             await message.reply_text("You have already added 2 free channels. To add more, please buy premium.")
             return
@@ -178,11 +449,9 @@ async def addchannel_command(client, message: Message):
         'is_premium': is_premium,
         'added_date': datetime.datetime.now()
     }
-    user_channels_collection.update_one(
-        {'user_id': user_id, 'channel_id': channel_id},
-        {'$set': user_channel_doc},
-        upsert=True
-    )
+    await db.user_channels.link(user_channel_doc)
+    channel_registry.add(channel_id)
+    await cache_sync.publish('channels', channel_id)
 
     channel_info = await client.get_chat(channel_id)
     
@@ -193,11 +462,7 @@ async def addchannel_command(client, message: Message):
         'joined': datetime.datetime.now(),
         'added_by_user': user_id
     }
-    channels_collection.update_one(
-        {'channel_id': channel_id},
-        {'$set': channel_doc},
-        upsert=True
-    )
+    await db.channels.upsert(channel_doc)
     
     if is_premium:
         await message.reply_text(f"✅ Channel `{channel_info.title}` has been successfully added to your premium account. You can add unlimited channels.")
@@ -208,6 +473,7 @@ async def addchannel_command(client, message: Message):
 
 
 @app.on_message(filters.command("removechannel") & filters.private)
+@instrument_handler
 async def removechannel_command(client, message: Message):
     user_id = message.from_user.id
     if len(message.command) < 2:
@@ -220,14 +486,16 @@ async def removechannel_command(client, message: Message):
         await message.reply_text("Invalid channel ID. Please provide a valid numerical ID.")
         return
 
-    result = user_channels_collection.delete_one({'user_id': user_id, 'channel_id': channel_id})
-    if result.deleted_count > 0:
+    if await db.user_channels.unlink(user_id, channel_id):
+        await channel_registry.discard(channel_id)
+        await cache_sync.publish('channels', channel_id)
         await message.reply_text(f"✅ Channel `{channel_id}` has been successfully removed from your account.")
     else:
         await message.reply_text(f"Channel `{channel_id}` was not found in your list of added channels.")
 
 
 @app.on_message(filters.command("add_premium") & filters.private)
+@instrument_handler
 async def add_premium_command(client, message: Message):
     if message.from_user.id != ADMIN_ID:
         await message.reply_text("You are not authorized to use this command.")
@@ -238,16 +506,14 @@ async def add_premium_command(client, message: Message):
         premium_duration = 365 # 1 year
         expiry_date = datetime.datetime.now() + timedelta(days=premium_duration)
         
-        user_doc = users_collection.find_one({'user_id': premium_user_id})
+        user_doc = await db.users.get(premium_user_id)
         if not user_doc:
             await message.reply_text(f"User with ID `{premium_user_id}` not found in the database.")
             return
 
-        premium_users_collection.update_one(
-            {'user_id': premium_user_id},
-            {'$set': {'expiry_date': expiry_date, 'added_by_admin': ADMIN_ID}},
-            upsert=True
-        )
+        await db.premium.grant(premium_user_id, expiry_date, ADMIN_ID)
+        premium_cache.invalidate(premium_user_id)
+        await cache_sync.publish('premium', premium_user_id)
         
         await message.reply_text(f"User `{premium_user_id}` has been granted premium for 1 year.")
         
@@ -260,6 +526,7 @@ async def add_premium_command(client, message: Message):
         await message.reply_text("Usage: /add_premium <user_id>")
 
 @app.on_message(filters.command("remove_premium") & filters.private)
+@instrument_handler
 async def remove_premium_command(client, message: Message):
     if message.from_user.id != ADMIN_ID:
         await message.reply_text("You are not authorized to use this command.")
@@ -267,8 +534,10 @@ async def remove_premium_command(client, message: Message):
     try:
         args = message.command
         premium_user_id = int(args[1])
-        result = premium_users_collection.delete_one({'user_id': premium_user_id})
-        if result.deleted_count > 0:
+        removed = await db.premium.revoke(premium_user_id)
+        premium_cache.invalidate(premium_user_id)
+        await cache_sync.publish('premium', premium_user_id)
+        if removed:
             await message.reply_text(f"Premium status for user `{premium_user_id}` has been removed successfully.")
         else:
             await message.reply_text(f"User `{premium_user_id}` does not have an active premium subscription.")
@@ -276,31 +545,33 @@ async def remove_premium_command(client, message: Message):
         await message.reply_text("Usage: /remove_premium <user_id>")
 
 @app.on_message(filters.command("stats") & filters.private)
+@instrument_handler
 async def stats_command(client, message: Message):
     if message.from_user.id != ADMIN_ID:
         await message.reply_text("You are not authorized to use this command.")
         return
-    user_count = users_collection.count_documents({})
-    channel_count = channels_collection.count_documents({})
-    premium_count = premium_users_collection.count_documents({'expiry_date': {'$gt': datetime.datetime.now()}})
+    totals = await db.counters.totals()
+    if totals is None:
+        totals = await db.counters.reconcile(db)
     stats_text = (
         f"📊 **Bot Stats**\n\n"
-        f"Total Users: {user_count}\n"
-        f"Total Channels Bot is in: {channel_count}\n"
-        f"Premium Users: {premium_count}"
+        f"Total Users: {totals.get('users', 0)}\n"
+        f"Total Channels Bot is in: {totals.get('channels', 0)}\n"
+        f"Channel Links: {totals.get('channel_links', 0)}\n"
+        f"Premium Users: {totals.get('premium_active', 0)}\n"
+        f"Channel Lookups Saved: {channel_registry.lookups_saved}\n"
+        f"Duplicate Updates Skipped: {handled_messages.stats['memory_hits'] + handled_messages.stats['mongo_hits']} "
+        f"(hit rate {handled_messages.hit_rate():.1%}, {handled_messages.stats['mongo_hits']} from Mongo)"
     )
-    await message.reply_text(stats_text, parse_mode='Markdown')
+    await message.reply_text(stats_text)
 
-@app.on_message(filters.command("premium_stats") & filters.private)
-async def premium_stats_command(client, message: Message):
-    if message.from_user.id != ADMIN_ID:
-        await message.reply_text("You are not authorized to use this command.")
-        return
-    premium_users = premium_users_collection.find({})
-    premium_list = list(premium_users)
+PREMIUM_STATS_PAGE_SIZE = 10
+
+async def premium_stats_page(after_id=None, before_id=None):
+    """Builds the text and navigation buttons for one page of premium users."""
+    premium_list, has_more = await db.premium.page(after_id, before_id, PREMIUM_STATS_PAGE_SIZE)
     if not premium_list:
-        await message.reply_text("No premium users found.")
-        return
+        return "No premium users found.", None
     stats_text = "👑 **Premium User Stats**\n\n"
     for user in premium_list:
         user_id = user['user_id']
@@ -310,9 +581,40 @@ async def premium_stats_command(client, message: Message):
         stats_text += f"**Status:** {status}\n"
         stats_text += f"**Expiry Date:** {expiry_date.strftime('%Y-%m-%d %H:%M:%S')}\n"
         stats_text += "-------------------------\n"
-    await message.reply_text(stats_text, parse_mode='Markdown')
+
+    # Paging backwards, `has_more` tells whether there is a previous page; a next page always exists.
+    has_prev = has_more if before_id is not None else after_id is not None
+    has_next = has_more if before_id is None else True
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"premium_page:prev:{premium_list[0]['_id']}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"premium_page:next:{premium_list[-1]['_id']}"))
+    return stats_text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+@app.on_message(filters.command("premium_stats") & filters.private)
+@instrument_handler
+async def premium_stats_command(client, message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.reply_text("You are not authorized to use this command.")
+        return
+    stats_text, reply_markup = await premium_stats_page()
+    await message.reply_text(stats_text, reply_markup=reply_markup)
+
+STATS_RECONCILE_INTERVAL = int(os.environ.get('STATS_RECONCILE_INTERVAL', 600))
+
+async def reconcile_counters():
+    """Periodically recomputes the stats counters to correct drift and premium expiries."""
+    while True:
+        try:
+            if coordinator.owns(ADMIN_ID):
+                await db.counters.reconcile(db)
+        except Exception as e:
+            logger.error(f"Failed to reconcile stats counters: {e}")
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
 
 @app.on_message(filters.command("broadcast") & filters.private)
+@instrument_handler
 async def broadcast_command(client, message: Message):
     if message.from_user.id != ADMIN_ID:
         await message.reply_text("You are not authorized to use this command.")
@@ -322,26 +624,12 @@ async def broadcast_command(client, message: Message):
         return
     
     message_to_broadcast = message.reply_to_message
-    users = users_collection.find({})
-    sent_count = 0
-    blocked_count = 0
-    for user_doc in users:
-        try:
-            await client.copy_message(
-                chat_id=user_doc['user_id'],
-                from_chat_id=message_to_broadcast.chat.id,
-                message_id=message_to_broadcast.id
-            )
-            sent_count += 1
-            await asyncio.sleep(0.1)
-        except UserIsBlocked:
-            blocked_count += 1
-        except Exception:
-            blocked_count += 1
-    await message.reply_text(f"User Broadcast complete. Sent to {sent_count} users. Blocked by {blocked_count} users.")
+    progress_message = await message.reply_text("📣 User Broadcast started...")
+    await broadcasts.create(client, 'users', message_to_broadcast, progress_message)
 
 
 @app.on_message(filters.command("channel_broadcast") & filters.private)
+@instrument_handler
 async def channel_broadcast_command(client, message: Message):
     if message.from_user.id != ADMIN_ID:
         await message.reply_text("You are not authorized to use this command.")
@@ -351,37 +639,116 @@ async def channel_broadcast_command(client, message: Message):
         return
     
     message_to_broadcast = message.reply_to_message
-    channels = channels_collection.find({})
-    sent_count = 0
-    failed_count = 0
-    for channel_doc in channels:
-        channel_id = channel_doc['channel_id']
-        try:
-            await client.copy_message(
-                chat_id=channel_id,
-                from_chat_id=message_to_broadcast.chat.id,
-                message_id=message_to_broadcast.id
-            )
-            sent_count += 1
-            await asyncio.sleep(0.1)
-        except Exception:
-            failed_count += 1
-    await message.reply_text(f"Channel Broadcast complete. Sent to {sent_count} channels. Failed on {failed_count} channels.")
+    progress_message = await message.reply_text("📣 Channel Broadcast started...")
+    await broadcasts.create(client, 'channels', message_to_broadcast, progress_message)
+
+def parse_job_id(message: Message):
+    """Returns the broadcast job ID given as the command argument, or None if missing/invalid."""
+    try:
+        return ObjectId(message.command[1])
+    except (IndexError, InvalidId, TypeError):
+        return None
+
+@app.on_message(filters.command("broadcast_status") & filters.private)
+@instrument_handler
+async def broadcast_status_command(client, message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.reply_text("You are not authorized to use this command.")
+        return
+    await message.reply_text(await broadcasts.status_text(parse_job_id(message)))
+
+@app.on_message(filters.command(["broadcast_pause", "broadcast_resume", "broadcast_cancel"]) & filters.private)
+@instrument_handler
+async def broadcast_control_command(client, message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.reply_text("You are not authorized to use this command.")
+        return
+    action = message.command[0].split('_')[1]
+    job_id = parse_job_id(message)
+    if job_id is None:
+        await message.reply_text(f"Usage: /broadcast_{action} <job_id>")
+        return
+    if action == 'pause':
+        done = await broadcasts.pause(job_id)
+    elif action == 'resume':
+        done = await broadcasts.resume(client, job_id)
+    else:
+        done = await broadcasts.cancel(job_id)
+    past_tense = {'pause': "paused", 'resume': "resumed", 'cancel': "cancelled"}[action]
+    if done:
+        await message.reply_text(f"✅ Broadcast `{job_id}` {past_tense}.")
+    else:
+        await message.reply_text(f"Broadcast `{job_id}` was not found or cannot be {past_tense} in its current state.")
+
+@app.on_message(filters.command("queue_stats") & filters.private)
+@instrument_handler
+async def queue_stats_command(client, message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.reply_text("You are not authorized to use this command.")
+        return
+    stats = scheduler.snapshot()
+    stats_text = (
+        f"📬 **Channel Queue Stats** ({coordinator.describe()})\n\n"
+        f"Queued Messages: {stats['depth']} in {stats['channels']} channels\n"
+        f"Channels Parked by FloodWait: {stats['parked']}\n"
+        f"Processed: {stats['processed']}\n"
+        f"FloodWaits: {stats['flood_waits']}, Retries: {stats['retries']}, Dropped: {stats['dropped']}\n"
+        f"Queue Wait: avg {stats['avg_wait']:.2f}s, max {stats['max_wait']:.2f}s\n"
+    )
+    if stats['deepest']:
+        stats_text += "\n**Deepest Queues:**\n"
+        for channel_id, depth in stats['deepest']:
+            stats_text += f"`{channel_id}`: {depth}\n"
+    await message.reply_text(stats_text)
+
+@app.on_message(filters.command("explain_queries") & filters.private)
+@instrument_handler
+async def explain_queries_command(client, message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.reply_text("You are not authorized to use this command.")
+        return
+    try:
+        report = await db.explain_hot_queries()
+    except Exception as e:
+        await message.reply_text(f"Could not explain queries: {e}")
+        return
+    scans = 0
+    report_text = "🔎 **Query Plans**\n\n"
+    for name, stages, index_names in report:
+        if 'COLLSCAN' in stages:
+            scans += 1
+            report_text += f"⚠️ {name}: COLLSCAN\n"
+        else:
+            report_text += f"✅ {name}: {', '.join(index_names) or ' > '.join(stages)}\n"
+    report_text += f"\nCollection scans: {scans}"
+    await message.reply_text(report_text)
+
+@app.on_message(filters.command("prune_stats") & filters.private)
+@instrument_handler
+async def prune_stats_command(client, message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.reply_text("You are not authorized to use this command.")
+        return
+    user_counts = await db.users.inactive_counts()
+    channel_counts = await db.channels.inactive_counts()
+    stats_text = "🧹 **Inactive Recipients**\n\n"
+    for label, counts in [("Users", user_counts), ("Channels", channel_counts)]:
+        stats_text += (
+            f"**{label}:** {sum(counts.values())} skipped by broadcasts\n"
+            f"Blocked: {counts.get('blocked', 0)}\n"
+            f"Deactivated: {counts.get('deactivated', 0)}\n"
+            f"Chat not found: {counts.get('not_found', 0)}\n\n"
+        )
+    stats_text += "Users are reactivated automatically when they send /start again."
+    await message.reply_text(stats_text)
 
 # --- Callback Query Handlers ---
 @app.on_callback_query(filters.regex("verify_member"))
+@instrument_handler
 async def verify_member_callback(client, query):
-    user_id = query.from_user.id
-    is_member = False
-    try:
-        member = await client.get_chat_member(FORCE_SUBSCRIBE_CHANNEL, user_id)
-        if member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
-            is_member = True
-    except RPCError as e:
-        logger.error(f"Error verifying member status for user {user_id}: {e}")
-    except Exception as e:
-        logger.error(f"Unexpected error in verification callback: {e}")
-    
+    # The user says they just joined, so a cached "not a member" must not be trusted.
+    is_member = await membership_cache.is_member(client, query.from_user.id, recheck_negative=True)
+
     if is_member:
         main_keyboard = [
             [InlineKeyboardButton("➕ Add Me to Your Channel", url=f"https://t.me/{client.me.username}?startgroup=start")],
@@ -393,7 +760,27 @@ async def verify_member_callback(client, query):
     else:
         await query.answer("❌ आप अभी भी चैनल में शामिल नहीं हुए हैं। कृपया पहले ज्वाइन करें।", show_alert=True)
 
+@app.on_callback_query(filters.regex("^premium_page:"))
+@instrument_handler
+async def premium_page_callback(client, query):
+    if query.from_user.id != ADMIN_ID:
+        await query.answer("You are not authorized to use this.", show_alert=True)
+        return
+    _, direction, page_id = query.data.split(':')
+    try:
+        page_id = ObjectId(page_id)
+    except InvalidId:
+        await query.answer()
+        return
+    if direction == 'next':
+        stats_text, reply_markup = await premium_stats_page(after_id=page_id)
+    else:
+        stats_text, reply_markup = await premium_stats_page(before_id=page_id)
+    await query.answer()
+    await query.edit_message_text(stats_text, reply_markup=reply_markup)
+
 @app.on_callback_query()
+@instrument_handler
 async def callback_handler(client, query):
     data = query.data
     user_id = query.from_user.id
@@ -439,34 +826,247 @@ async def callback_handler(client, query):
         await query.edit_message_text(f"Hi {user.first_name}! Welcome back.", reply_markup=InlineKeyboardMarkup(main_keyboard))
 
 # --- Pyrogram forward tag removal logic ---
-@app.on_message(filters.chat(lambda _, __, m: user_channels_collection.find_one({'channel_id': m.chat.id})))
-async def handle_forwarded_messages(client, message: Message):
+@app.on_chat_member_updated()
+@instrument_handler
+async def bot_member_updated(client, update):
+    """Keeps the permission cache in sync when the bot is promoted, restricted or removed."""
+    if not update.new_chat_member or update.new_chat_member.user.id != client.me.id:
+        return
+    can_delete = can_bot_delete(update.new_chat_member)
+    if bot_permissions.set(update.chat.id, can_delete) and not can_delete and update.chat.id in channel_registry.channel_ids:
+        warn_missing_permission(update.chat)
+
+@app.on_chat_member_updated(filters.chat(FORCE_SUBSCRIBE_CHANNEL), group=1)
+@instrument_handler
+async def force_subscribe_member_updated(client, update):
+    """Updates the membership cache on joins and leaves (only delivered if the bot is admin there)."""
+    member = update.new_chat_member or update.old_chat_member
+    if not member or not member.user:
+        return
+    is_member = bool(update.new_chat_member) and update.new_chat_member.status in MEMBER_STATUSES
+    membership_cache.set(member.user.id, is_member)
+    await cache_sync.publish('membership', member.user.id)
+
+def warn_missing_permission(chat):
+    log_message = f"**WARNING:** Bot is not an admin or lacks `can_delete_messages` permission in channel `{chat.title}` (`{chat.id}`). Forward tag cannot be removed."
+    log_event(log_message, PRIORITY_WARNING)
+    logger.warning(f"Bot lacks 'can_delete_messages' permission in channel: {chat.title} ({chat.id})")
+
+async def bot_can_delete_in(client, chat) -> bool:
+    """Checks the bot's delete permission in a channel, using the cache when possible."""
+    can_delete = bot_permissions.get(chat.id)
+    if can_delete is MISSING:
+        bot_member = await client.get_chat_member(chat.id, client.me.id)
+        can_delete = can_bot_delete(bot_member)
+        if bot_permissions.set(chat.id, can_delete) and not can_delete:
+            warn_missing_permission(chat)
+    return can_delete
+
+async def repost_without_tag(client, chat, messages: list, progress: dict) -> bool:
+    """Reposts forwarded messages without the forward tag and deletes the originals.
+
+    `messages` is either a single message or every message of one album. FloodWait
+    is left to the scheduler, which retries the job later; `progress` records the
+    steps already done so a retry does not post the copy twice. Returns False if
+    the forward tag could not be removed.
+    """
     try:
-        if message.forward_from_chat or message.forward_from:
-            # Check if bot has delete permission in the channel
-            bot_member = await client.get_chat_member(message.chat.id, client.me.id)
-            if bot_member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER] and bot_member.privileges.can_delete_messages:
-                # Copy the message without the forward tag
-                await message.copy(chat_id=message.chat.id)
-                # Delete the original message with the forward tag
-                await message.delete()
-                logger.info(f"Forwarded message removed and resent in channel: {message.chat.title} ({message.chat.id})")
+        # Check if bot has delete permission in the channel
+        if not await bot_can_delete_in(client, chat):
+            return False
+        if not progress.get('copied'):
+            if messages[0].media_group_id:
+                # Copy the whole album in one call
+                await client.copy_media_group(chat_id=chat.id, from_chat_id=chat.id, message_id=messages[0].id)
             else:
-                log_message = f"**WARNING:** Bot is not an admin or lacks `can_delete_messages` permission in channel `{message.chat.title}` (`{message.chat.id}`). Forward tag cannot be removed."
-                await log_event(client, log_message)
-                logger.warning(f"Bot lacks 'can_delete_messages' permission in channel: {message.chat.title} ({message.chat.id})")
-    except FloodWait as e:
-        logger.warning(f"FloodWait error: Sleeping for {e.value} seconds.")
-        await asyncio.sleep(e.value)
+                # Copy the message without the forward tag
+                await messages[0].copy(chat_id=chat.id)
+            progress['copied'] = True
+        # Delete the original messages with the forward tag
+        if messages[0].media_group_id:
+            await client.delete_messages(chat_id=chat.id, message_ids=[m.id for m in messages])
+        else:
+            await messages[0].delete()
+        logger.info(f"Forwarded message removed and resent in channel: {chat.title} ({chat.id})")
+        return True
+    except FloodWait:
+        raise
+    except (ChatAdminRequired, ChatWriteForbidden, MessageDeleteForbidden) as e:
+        # Cached permissions are stale; the next message will fetch them again.
+        bot_permissions.invalidate(chat.id)
+        logger.warning(f"Permission error in channel {chat.id}, cache invalidated: {e}")
+        return False
     except Exception as e:
-        logger.error(f"Failed to handle forwarded message in channel {message.chat.id}: {e}")
-        log_message = f"**ERROR:** An unexpected error occurred in channel `{message.chat.title}` (`{message.chat.id}`): `{e}`"
-        await log_event(client, log_message)
+        logger.error(f"Failed to handle forwarded message in channel {chat.id}: {e}")
+        log_message = f"**ERROR:** An unexpected error occurred in channel `{chat.title}` (`{chat.id}`): `{e}`"
+        log_event(log_message, PRIORITY_ERROR)
+        return False
+
+class HandledMessages(TTLCache):
+    """Remembers handled (chat_id, message_id) pairs so redelivered updates are skipped.
+
+    Up to `max_size` recent messages are kept in memory for `ttl` seconds,
+    least recently seen first out. With DEDUP_PERSIST_WINDOW set, misses are
+    also claimed in Mongo so the window survives restarts and is shared by
+    shard workers.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        super().__init__(ttl, max_size)
+        self.stats = {'memory_hits': 0, 'mongo_hits': 0, 'misses': 0}
+
+    async def seen(self, chat_id: int, message_id: int) -> bool:
+        """Marks the message as handled and returns True if it already was."""
+        key = (chat_id, message_id)
+        if self.get(key) is not MISSING:
+            self.stats['memory_hits'] += 1
+            return True
+        self.set(key, True)
+        if DEDUP_PERSIST_WINDOW > 0:
+            try:
+                if not await db.processed_messages.claim(chat_id, message_id):
+                    self.stats['mongo_hits'] += 1
+                    return True
+            except Exception as e:
+                logger.error(f"Failed to record handled message {chat_id}:{message_id}: {e}")
+        self.stats['misses'] += 1
+        return False
+
+    async def forget(self, messages: list):
+        """Lets redeliveries of `messages` through again, e.g. after their repost was dropped."""
+        chat_id = messages[0].chat.id
+        for message in messages:
+            self.invalidate((chat_id, message.id))
+        if DEDUP_PERSIST_WINDOW > 0:
+            try:
+                await db.processed_messages.release(chat_id, [message.id for message in messages])
+            except Exception as e:
+                logger.error(f"Failed to release handled messages in {chat_id}: {e}")
+
+    def hit_rate(self) -> float:
+        hits = self.stats['memory_hits'] + self.stats['mongo_hits']
+        total = hits + self.stats['misses']
+        return hits / total if total else 0.0
+
+handled_messages = HandledMessages(
+    max_size=int(os.environ.get('DEDUP_CACHE_SIZE', 10000)),
+    ttl=int(os.environ.get('DEDUP_CACHE_TTL', 3600)),
+)
+
+class AlbumBuffer:
+    """Collects the messages of a forwarded album so it can be reposted in one go.
+
+    Telegram delivers each album item as a separate update. An album is flushed
+    once no new item has arrived for `window` seconds.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self.albums = {}
+
+    def add(self, client, message: Message):
+        key = (message.chat.id, message.media_group_id)
+        album = self.albums.get(key)
+        if album:
+            album['messages'].append(message)
+            album['last_seen'] = time.monotonic()
+            return
+        self.albums[key] = {'messages': [message], 'last_seen': time.monotonic()}
+        start_background_task(self.flush_when_complete(client, key))
+
+    async def flush_when_complete(self, client, key):
+        while True:
+            delay = self.albums[key]['last_seen'] + self.window - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        messages = sorted(self.albums.pop(key)['messages'], key=lambda m: m.id)
+        schedule_repost(client, messages)
+
+def schedule_repost(client, messages: list):
+    """Queues the repost. Messages are marked handled on arrival so redeliveries that come
+    in while the job is queued are skipped; if the tag is not removed, the mark is lifted."""
+    chat = messages[0].chat
+    progress = {}
+
+    async def repost():
+        if not await repost_without_tag(client, chat, messages, progress):
+            await handled_messages.forget(messages)
+
+    scheduler.submit(chat.id, repost, on_drop=partial(handled_messages.forget, messages))
+
+scheduler = ChannelScheduler()
+CHANNEL_QUEUE_DEPTH.set_function(lambda: sum(len(channel.jobs) for channel in scheduler.channels.values()))
+CHANNELS_PARKED.set_function(lambda: scheduler.snapshot()['parked'])
+album_buffer = AlbumBuffer(window=float(os.environ.get('ALBUM_COLLECT_WINDOW', 1.5)))
+
+@app.on_message(registered_channel)
+@instrument_handler
+async def handle_forwarded_messages(client, message: Message):
+    if not (message.forward_from_chat or message.forward_from):
+        return
+    if await handled_messages.seen(message.chat.id, message.id):
+        return
+    if message.media_group_id:
+        album_buffer.add(client, message)
+    else:
+        schedule_repost(client, [message])
+
+background_tasks = set()
+
+def start_background_task(coro):
+    """Schedules a long-running task and keeps a reference so it is not garbage collected."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def run_bot():
+    if WEB_SERVER == 'asyncio':
+        web_server = WebServer(WEB_ROUTES, '0.0.0.0', WEB_PORT)
+        await web_server.start()
+    else:
+        Thread(target=run_flask_app, daemon=True).start()
+
+    started = time.perf_counter()
+    await db.ping()
+    await db.ensure_indexes()
+    await channel_registry.load()
+    startup_timings['mongo'] = time.perf_counter() - started
+
+    scheduler.start()
+    # Leases are taken before the client starts so the updates Pyrogram replays on startup
+    # reach a worker that already knows which chats it owns.
+    await coordinator.start()
+    started = time.perf_counter()
+    await app.start()
+    startup_timings['telegram'] = time.perf_counter() - started
+    logger.info(
+        f"Startup timings: imports {startup_timings['imports']:.2f}s, "
+        f"mongo {startup_timings['mongo']:.2f}s, telegram auth {startup_timings['telegram']:.2f}s, "
+        f"total {time.perf_counter() - startup_timings['started']:.2f}s"
+    )
+    if coordinator.owns(ADMIN_ID):
+        await broadcasts.resume_unfinished(app)
+    start_background_task(log_sink.run(app))
+    start_background_task(sweep_caches())
+    start_background_task(reconcile_counters())
+    start_background_task(monitor_event_loop())
+    if CHANNEL_RESYNC_INTERVAL > 0:
+        start_background_task(resync_channel_registry())
+    if coordinator.enabled:
+        start_background_task(cache_sync.run())
+    await idle()
+    # Hands this worker's chats to the others now rather than after the leases expire.
+    await coordinator.stop()
+    await log_sink.flush(app)
+    await app.stop()
+    if WEB_SERVER == 'asyncio':
+        await web_server.stop()
 
 def main():
     logger.info("Starting bot and web server...")
-    Thread(target=run_flask_app).start()
-    app.run()
+    app.run(run_bot())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,100 @@
+import asyncio
+import contextvars
+import time
+from functools import wraps
+
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from pyrogram import Client
+from pyrogram.session import Session
+from pyrogram.errors import FloodWait, RPCError
+
+# --- Metrics ---
+HANDLER_LATENCY = Histogram('bot_handler_seconds', 'Time spent in Pyrogram handlers.', ['handler'])
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Exceptions raised by Pyrogram handlers.', ['handler'])
+TELEGRAM_LATENCY = Histogram('bot_telegram_request_seconds', 'Telegram API call latency.', ['method'])
+TELEGRAM_ERRORS = Counter('bot_telegram_errors_total', 'Telegram API calls that raised an RPC error.', ['method', 'error'])
+FLOOD_WAITS = Counter('bot_flood_waits_total', 'FloodWait errors returned by Telegram.', ['method'])
+FLOOD_WAIT_SECONDS = Counter('bot_flood_wait_seconds_total', 'Total seconds Telegram asked us to wait.', ['method'])
+MONGO_LATENCY = Histogram(
+    'bot_mongo_operation_seconds', 'MongoDB operation latency, including executor wait.', ['collection', 'operation']
+)
+EVENT_LOOP_LAG = Gauge('bot_event_loop_lag_seconds', 'How late the last event loop heartbeat fired.')
+CHANNEL_QUEUE_DEPTH = Gauge('bot_channel_queue_depth', 'Messages waiting in the per-channel queues.')
+CHANNELS_PARKED = Gauge('bot_channels_parked', 'Channels parked by FloodWait.')
+
+EVENT_LOOP_INTERVAL = 1.0
+# Overrides the sleep threshold of RPCs made in the current context. The scheduler workers
+# and broadcasts set it to RAISE_FLOOD_WAIT; unset, Pyrogram's own thresholds apply.
+flood_sleep_threshold = contextvars.ContextVar('flood_sleep_threshold', default=None)
+# Sleep threshold under which every FloodWait is raised to the caller instead of slept through.
+RAISE_FLOOD_WAIT = 0
+# Updated by monitor_event_loop; read by the health check.
+loop_heartbeat = {'last_tick': None, 'lag': 0.0}
+
+
+def instrument_handler(func):
+    """Times a Pyrogram handler and counts the exceptions it raises."""
+    latency = HANDLER_LATENCY.labels(func.__name__)
+    errors = HANDLER_ERRORS.labels(func.__name__)
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - start)
+    return wrapper
+
+
+class InstrumentedClient(Client):
+    """Pyrogram client that records latency and errors for every raw API call.
+
+    All high-level methods (copy, delete, get_chat_member, send_message, ...)
+    go through `invoke`, so they are labelled by the raw function name,
+    e.g. `functions.messages.DeleteMessages`.
+
+    Where the context sets `flood_sleep_threshold`, it replaces the sleep
+    threshold that methods pass themselves (60s for copy_media_group, "always
+    sleep" for get_messages), so FloodWait reaches the scheduler and
+    broadcasts instead of blocking one of their workers inside the RPC.
+    Elsewhere, e.g. in handlers, in Pyrogram's own fetches while parsing
+    updates and during start-up, the method's or the client's threshold applies.
+    """
+
+    async def invoke(
+        self, query, retries: int = Session.MAX_RETRIES, timeout: float = Session.WAIT_TIMEOUT, sleep_threshold: float = None
+    ):
+        method = getattr(query, 'QUALNAME', type(query).__name__)
+        threshold = flood_sleep_threshold.get()
+        start = time.perf_counter()
+        try:
+            return await super().invoke(query, retries, timeout, sleep_threshold if threshold is None else threshold)
+        except FloodWait as e:
+            FLOOD_WAITS.labels(method).inc()
+            FLOOD_WAIT_SECONDS.labels(method).inc(e.value)
+            raise
+        except RPCError as e:
+            TELEGRAM_ERRORS.labels(method, type(e).__name__).inc()
+            raise
+        finally:
+            TELEGRAM_LATENCY.labels(method).observe(time.perf_counter() - start)
+
+
+async def monitor_event_loop():
+    """Measures event loop lag as the delay of a periodic heartbeat."""
+    while True:
+        expected = time.monotonic() + EVENT_LOOP_INTERVAL
+        await asyncio.sleep(EVENT_LOOP_INTERVAL)
+        now = time.monotonic()
+        loop_heartbeat['lag'] = max(0.0, now - expected)
+        loop_heartbeat['last_tick'] = now
+        EVENT_LOOP_LAG.set(loop_heartbeat['lag'])
+
+
+def render_metrics():
+    """Returns the metrics body and content type in Prometheus text format."""
+    return generate_latest(), CONTENT_TYPE_LATEST
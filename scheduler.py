@@ -0,0 +1,132 @@
+import asyncio
+import collections
+import logging
+import os
+import time
+
+from pyrogram.errors import FloodWait
+
+from metrics import RAISE_FLOOD_WAIT, flood_sleep_threshold
+
+logger = logging.getLogger(__name__)
+
+# --- Scheduler Settings ---
+SCHEDULER_WORKERS = int(os.environ.get('SCHEDULER_WORKERS', 4))
+SCHEDULER_MAX_RETRIES = int(os.environ.get('SCHEDULER_MAX_RETRIES', 5))
+
+
+class ChannelQueue:
+    def __init__(self):
+        self.jobs = collections.deque()
+        self.parked_until = 0.0
+        # True while the channel is waiting in the ready queue or being worked on.
+        self.scheduled = False
+
+
+class ChannelScheduler:
+    """Runs jobs with one FIFO queue per channel and a fair round-robin dispatcher.
+
+    Each channel has at most one job in flight, so its messages keep their
+    order. A job that raises FloodWait is put back at the front of its
+    channel's queue and the channel is parked until the wait is over, while
+    workers keep serving every other channel. A job that fails otherwise or
+    runs out of retries is dropped, and its `on_drop` callback is awaited.
+    """
+
+    def __init__(self, workers: int = SCHEDULER_WORKERS, max_retries: int = SCHEDULER_MAX_RETRIES):
+        self.workers = workers
+        self.max_retries = max_retries
+        self.channels = {}
+        self.ready = None
+        self.tasks = []
+        self.stats = {'processed': 0, 'retries': 0, 'flood_waits': 0, 'dropped': 0, 'started': 0, 'total_wait': 0.0, 'max_wait': 0.0}
+
+    def start(self):
+        self.ready = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    def submit(self, channel_id: int, job, on_drop=None):
+        """Queues `job`, a zero-argument coroutine function, for `channel_id`.
+
+        `on_drop`, also a zero-argument coroutine function, is awaited if the job is dropped.
+        """
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = ChannelQueue()
+        channel.jobs.append([job, time.monotonic(), 0, on_drop])
+        self.schedule(channel_id)
+
+    def schedule(self, channel_id: int):
+        channel = self.channels[channel_id]
+        if channel.scheduled or not channel.jobs or channel.parked_until > time.monotonic():
+            return
+        channel.scheduled = True
+        self.ready.put_nowait(channel_id)
+
+    def unpark(self, channel_id: int):
+        channel = self.channels.get(channel_id)
+        if channel:
+            channel.parked_until = 0.0
+            self.schedule(channel_id)
+
+    async def worker(self):
+        # FloodWait must reach the loop below, which parks the channel, rather than block this worker.
+        flood_sleep_threshold.set(RAISE_FLOOD_WAIT)
+        while True:
+            channel_id = await self.ready.get()
+            channel = self.channels[channel_id]
+            entry = channel.jobs.popleft()
+            job, queued_at, attempts, on_drop = entry
+            if attempts == 0:
+                self.stats['started'] += 1
+                wait = time.monotonic() - queued_at
+                self.stats['total_wait'] += wait
+                self.stats['max_wait'] = max(self.stats['max_wait'], wait)
+            try:
+                await job()
+                self.stats['processed'] += 1
+            except FloodWait as e:
+                self.stats['flood_waits'] += 1
+                if attempts < self.max_retries:
+                    entry[2] += 1
+                    self.stats['retries'] += 1
+                    channel.jobs.appendleft(entry)
+                    channel.parked_until = time.monotonic() + e.value
+                    asyncio.get_running_loop().call_later(e.value, self.unpark, channel_id)
+                    logger.warning(f"FloodWait in channel {channel_id}: parked for {e.value} seconds.")
+                else:
+                    logger.error(f"Dropping job for channel {channel_id} after {attempts} FloodWait retries.")
+                    await self.drop(channel_id, on_drop)
+            except Exception as e:
+                logger.error(f"Scheduled job for channel {channel_id} failed: {e}")
+                await self.drop(channel_id, on_drop)
+            finally:
+                channel.scheduled = False
+                if not channel.jobs and channel.parked_until <= time.monotonic():
+                    del self.channels[channel_id]
+                else:
+                    # Back of the ready queue, so every other waiting channel gets a turn first.
+                    self.schedule(channel_id)
+
+    async def drop(self, channel_id: int, on_drop):
+        self.stats['dropped'] += 1
+        if on_drop is None:
+            return
+        try:
+            await on_drop()
+        except Exception as e:
+            logger.error(f"Drop callback for channel {channel_id} failed: {e}")
+
+    def snapshot(self) -> dict:
+        """Returns queue depths, parked channels and counters for monitoring."""
+        now = time.monotonic()
+        depths = {channel_id: len(channel.jobs) for channel_id, channel in self.channels.items()}
+        started = self.stats['started']
+        return {
+            **self.stats,
+            'depth': sum(depths.values()),
+            'channels': len(depths),
+            'parked': sum(1 for channel in self.channels.values() if channel.parked_until > now),
+            'avg_wait': self.stats['total_wait'] / started if started else 0.0,
+            'deepest': sorted(depths.items(), key=lambda item: item[1], reverse=True)[:5],
+        }
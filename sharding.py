@@ -0,0 +1,240 @@
+import asyncio
+import bisect
+import datetime
+import hashlib
+import logging
+import os
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+# --- Sharding Settings ---
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 1))
+SHARD_ID = int(os.environ.get('SHARD_ID', 0))
+SHARD_LEASE_TTL = float(os.environ.get('SHARD_LEASE_TTL', 20))
+SHARD_RENEW_INTERVAL = float(os.environ.get('SHARD_RENEW_INTERVAL', 5))
+# How often a restarted worker asks for its own slot while another worker hands it back.
+SHARD_HANDBACK_POLL = float(os.environ.get('SHARD_HANDBACK_POLL', 0.5))
+VIRTUAL_NODES = 64
+CACHE_SYNC_INTERVAL = float(os.environ.get('CACHE_SYNC_INTERVAL', 2))
+# Recent events are re-read on every poll, so events stamped by a worker with a slightly
+# slower clock are still picked up.
+CACHE_SYNC_LOOKBACK = 60
+
+
+def stable_hash(value) -> int:
+    return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring; changing the node count only moves the keys of the affected nodes."""
+
+    def __init__(self, nodes, replicas: int = VIRTUAL_NODES):
+        points = sorted((stable_hash(f"{node}:{i}"), node) for node in nodes for i in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        index = bisect.bisect(self.hashes, stable_hash(key)) % len(self.hashes)
+        return self.nodes[index]
+
+
+class ShardCoordinator:
+    """Decides which worker process acts on which chat.
+
+    Every worker runs its own Pyrogram session and receives every update;
+    chats are mapped to SHARD_COUNT slots by consistent hashing on the chat ID.
+    A worker only handles chats whose slot it holds a Mongo lease for. Each
+    worker keeps the lease on its own slot (SHARD_ID) and takes over the slot
+    of any worker whose lease expired, handing it back once that worker is
+    alive again. Leases are treated as lost locally before they expire in
+    Mongo, so two workers never act on the same slot at once.
+
+    The worker ID stays the same across restarts of a shard (SHARD_WORKER_ID,
+    by default host and shard ID), so a restarted worker can renew the leases
+    it held before. `stop` releases every lease on shutdown, so the slot is
+    taken over on the other workers' next refresh instead of after it expires.
+
+    With SHARD_COUNT=1 sharding is disabled and this worker owns every chat.
+    """
+
+    def __init__(self, leases, shard_count: int = SHARD_COUNT, shard_id: int = SHARD_ID):
+        self.leases = leases
+        self.shard_count = shard_count
+        self.shard_id = shard_id
+        self.worker_id = os.environ.get('SHARD_WORKER_ID') or f"{socket.gethostname()}:shard-{shard_id}"
+        self.ring = HashRing(range(shard_count))
+        # slot -> monotonic time until which this worker may act on it
+        self.held = {}
+        self.on_acquire = []
+        self.on_release = []
+        self.task = None
+        self.reclaim_task = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.shard_count > 1
+
+    def slot_for(self, chat_id: int) -> int:
+        return self.ring.node_for(chat_id) if self.enabled else 0
+
+    def owns_slot(self, slot: int) -> bool:
+        return not self.enabled or self.held.get(slot, 0) > time.monotonic()
+
+    def owns(self, chat_id: int) -> bool:
+        return self.owns_slot(self.slot_for(chat_id))
+
+    async def start(self):
+        if not self.enabled:
+            await self.acquired(0)
+            return
+        await self.refresh()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stops renewing and gives up every lease, so other workers can take over at once."""
+        for task in (self.task, self.reclaim_task):
+            if task:
+                task.cancel()
+        if not self.enabled:
+            return
+        for slot in list(self.held):
+            await self.released(slot)
+            await self.leases.release(f"slot:{slot}", self.worker_id)
+        await self.leases.release(f"worker:{self.shard_id}", self.worker_id)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(SHARD_RENEW_INTERVAL)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Shard lease refresh failed: {e}")
+            # Drop slots whose renewal did not succeed in time.
+            for slot in [slot for slot, valid_until in self.held.items() if valid_until <= time.monotonic()]:
+                await self.released(slot)
+
+    async def refresh(self):
+        """Renews held leases, claims our own slot and takes over slots of dead workers."""
+        if not await self.leases.acquire(f"worker:{self.shard_id}", self.worker_id, SHARD_LEASE_TTL):
+            logger.error(f"Another worker is running as shard {self.shard_id}; not claiming any slots.")
+            if self.reclaim_task:
+                self.reclaim_task.cancel()
+            for slot in list(self.held):
+                await self.released(slot)
+            return
+        for slot in range(self.shard_count):
+            if slot != self.shard_id and await self.worker_alive(slot):
+                if slot in self.held:
+                    # The slot's own worker is back; stop acting on the slot, then hand it over.
+                    await self.released(slot)
+                    await self.leases.release(f"slot:{slot}", self.worker_id)
+                continue
+            if not await self.claim(slot) and slot == self.shard_id and self.reclaim_task is None:
+                self.reclaim_task = asyncio.create_task(self.reclaim_own_slot())
+
+    async def claim(self, slot: int) -> bool:
+        """Takes or renews the lease on `slot`; returns True if this worker now holds it."""
+        started = time.monotonic()
+        if await self.leases.acquire(f"slot:{slot}", self.worker_id, SHARD_LEASE_TTL):
+            # Stop acting well before the lease can expire in Mongo.
+            valid_until = started + SHARD_LEASE_TTL - SHARD_RENEW_INTERVAL
+            if slot not in self.held:
+                self.held[slot] = valid_until
+                await self.acquired(slot)
+            else:
+                self.held[slot] = valid_until
+            return True
+        if slot in self.held:
+            await self.released(slot)
+        return False
+
+    async def reclaim_own_slot(self):
+        """Polls for this worker's own slot while the worker that covered for it hands it back.
+
+        That worker releases the slot on its next refresh; polling here takes it
+        right after, rather than up to a renew interval later.
+        """
+        try:
+            while self.shard_id not in self.held:
+                await asyncio.sleep(SHARD_HANDBACK_POLL)
+                try:
+                    await self.claim(self.shard_id)
+                except Exception as e:
+                    logger.error(f"Failed to reclaim shard slot {self.shard_id}: {e}")
+        finally:
+            self.reclaim_task = None
+
+    async def worker_alive(self, slot: int) -> bool:
+        lease = await self.leases.get(f"worker:{slot}")
+        return bool(lease) and lease['expires_at'] > datetime.datetime.utcnow()
+
+    async def acquired(self, slot: int):
+        logger.info(f"Worker {self.worker_id} now owns shard slot {slot}.")
+        for callback in self.on_acquire:
+            await callback(slot)
+
+    async def released(self, slot: int):
+        self.held.pop(slot, None)
+        logger.info(f"Worker {self.worker_id} released shard slot {slot}.")
+        for callback in self.on_release:
+            await callback(slot)
+
+    def describe(self) -> str:
+        if not self.enabled:
+            return "single worker"
+        slots = ', '.join(str(slot) for slot in sorted(self.held)) or "none"
+        return f"shard {self.shard_id}/{self.shard_count}, slots: {slots}"
+
+
+class CacheSync:
+    """Spreads cache invalidations between shard workers through Mongo.
+
+    Each worker only sees the updates for its own chats, so a change handled
+    on one worker (a channel added, premium granted, a user joining the
+    force-subscribe channel) has to reach the caches of the others. Workers
+    publish an event per change and poll for the events of others every
+    CACHE_SYNC_INTERVAL seconds. Handlers are keyed by cache name and get the
+    event's key; they should be idempotent.
+
+    With sharding disabled nothing is published or polled.
+    """
+
+    def __init__(self, events, coordinator: ShardCoordinator):
+        self.events = events
+        self.coordinator = coordinator
+        self.handlers = {}
+        # event _id -> created_at, for events already applied within the lookback window
+        self.applied = {}
+
+    def on(self, cache: str, handler):
+        self.handlers[cache] = handler
+
+    async def publish(self, cache: str, key):
+        if not self.coordinator.enabled:
+            return
+        try:
+            await self.events.publish(cache, key, self.coordinator.worker_id)
+        except Exception as e:
+            logger.error(f"Failed to publish {cache} invalidation for {key}: {e}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(CACHE_SYNC_INTERVAL)
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.error(f"Cache sync failed: {e}")
+
+    async def poll(self):
+        window_start = datetime.datetime.utcnow() - datetime.timedelta(seconds=CACHE_SYNC_LOOKBACK)
+        for event in await self.events.since(window_start):
+            if event['_id'] in self.applied or event['worker'] == self.coordinator.worker_id:
+                continue
+            self.applied[event['_id']] = event['created_at']
+            handler = self.handlers.get(event['cache'])
+            if handler:
+                await handler(event['key'])
+        for event_id in [event_id for event_id, created_at in self.applied.items() if created_at <= window_start]:
+            del self.applied[event_id]
@@ -0,0 +1,54 @@
+import collections
+import time
+
+# Returned by TTLCache.get for missing or expired keys, so that None can be cached.
+MISSING = object()
+
+
+class TTLCache:
+    """In-memory cache whose entries expire `ttl` seconds after they are set.
+
+    With `max_size` set, the least recently used entries are evicted once the
+    cache is full. Expired entries are dropped when read and by `sweep`, which
+    callers run periodically.
+    """
+
+    def __init__(self, ttl: float, max_size: int = None):
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (value, monotonic expiry time), least recently used first
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, default=MISSING):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        """Stores `value`; `ttl` overrides the cache's default lifetime for this entry."""
+        self.entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self.entries.move_to_end(key)
+        if self.max_size is not None:
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def sweep(self):
+        """Drops every expired entry."""
+        now = time.monotonic()
+        for key in [key for key, (_, expires_at) in self.entries.items() if expires_at <= now]:
+            del self.entries[key]
+
+    def __len__(self) -> int:
+        return len(self.entries)
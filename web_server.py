@@ -0,0 +1,65 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+REQUEST_TIMEOUT = 10
+STATUS_TEXT = {200: "OK", 404: "Not Found", 405: "Method Not Allowed", 503: "Service Unavailable"}
+
+
+class WebServer:
+    """Minimal HTTP/1.1 server for health and metrics routes, run on the bot's event loop.
+
+    `routes` maps a path to a coroutine function returning
+    (status, content_type, body). Only GET and HEAD are supported, and every
+    connection is closed after one response.
+    """
+
+    def __init__(self, routes: dict, host: str, port: int):
+        self.routes = routes
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        logger.info(f"Web server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+            # Skip the headers; none of the routes need them.
+            while (await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) < 2:
+                return
+            method, path = parts[0], parts[1].split('?', 1)[0]
+            route = self.routes.get(path)
+            if route is None:
+                status, content_type, body = 404, 'text/plain; charset=utf-8', "Not Found"
+            elif method not in ('GET', 'HEAD'):
+                status, content_type, body = 405, 'text/plain; charset=utf-8', "Method Not Allowed"
+            else:
+                status, content_type, body = await route()
+            if isinstance(body, str):
+                body = body.encode()
+            head = (
+                f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n"
+            ).encode()
+            writer.write(head if method == 'HEAD' else head + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Web server failed to handle request: {e}")
+        finally:
+            writer.close()